@@ -3,6 +3,7 @@ import click
 from ocrd.decorators import ocrd_cli_options, ocrd_cli_wrap_processor
 from .shell import ShellPreprocessor
 from .skimage_binarize import SkimageBinarize
+from .skimage_chain import SkimageChain
 from .skimage_denoise import SkimageDenoise
 from .skimage_denoise_raw import SkimageDenoiseRaw
 from .skimage_normalize import SkimageNormalize
@@ -31,3 +32,8 @@ def ocrd_skimage_binarize(*args, **kwargs):
 @ocrd_cli_options
 def ocrd_skimage_denoise(*args, **kwargs):
     return ocrd_cli_wrap_processor(SkimageDenoise, *args, **kwargs)
+
+@click.command()
+@ocrd_cli_options
+def ocrd_skimage_chain(*args, **kwargs):
+    return ocrd_cli_wrap_processor(SkimageChain, *args, **kwargs)
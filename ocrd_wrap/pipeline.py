@@ -0,0 +1,242 @@
+from __future__ import absolute_import
+
+import io
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+from ocrd import Processor
+from ocrd.processor import base as processor_base
+from ocrd_utils import MIME_TO_EXT, MIME_TO_PIL, MIMETYPE_PAGE
+from ocrd_modelfactory import page_from_file
+
+from .utils import matches_features
+
+
+class PagePipeline:
+    """Overlap the computation of pages with decoding their input and encoding their images.
+
+    Run the sequential page ``tasks`` of a processor in order, but compute up to
+    ``pages`` pages ahead of the one being awaited, so the encoding of result images
+    can happen behind (in a single writer thread). While a page is being computed,
+    parse the PAGE file of the next page and decode its images - the original and
+    the page-level AlternativeImages matching ``image_filter`` (keyword arguments
+    of ``image_from_page``) - ahead (in a single reader thread).
+
+    Pages are still computed by the processor's ``process_page_file``, but while
+    the pipeline runs, its ``page_from_file`` returns the PAGE parsed ahead (once),
+    and ``image_from_page`` of the workspace uses the images decoded ahead instead
+    of opening their files. Moreover, the ``add_file`` and ``save_image_file`` of
+    the workspace only queue their output for the page being computed. Only when
+    that page gets awaited (after all earlier pages have been reported) is its
+    output written and added to the METS - or its error raised. So the processor's
+    error handling applies to the right page, and pages computed ahead of an
+    aborting page leave no trace.
+
+    Everything that depends on the working directory or the METS happens in the
+    calling thread.
+    """
+
+    def __init__(self, processor, tasks, pages, image_filter):
+        self.processor = processor
+        self.workspace = processor.workspace
+        self.tasks = [(task, page_id, input_files)
+                      for task, (page_id, input_files) in tasks.items()]
+        self.pages = pages
+        self.image_filter = image_filter
+        self.computed = 0
+        self.current = None
+        self.errors = {}
+        self.queued = {}
+        self.prefetched = {}
+        self.prefetch = None
+        self.reader = ThreadPoolExecutor(max_workers=1)
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.page_from_file_ = processor_base.page_from_file
+        processor_base.page_from_file = self.page_from_file
+        self.apply_mets_file_ = self.workspace._apply_mets_file # pylint: disable=protected-access
+        self.workspace._apply_mets_file = self.apply_mets_file
+        self.add_file_ = self.workspace.add_file
+        self.workspace.add_file = self.add_file
+        self.workspace.save_image_file = self.save_image_file
+
+    def page_tasks(self) -> dict:
+        """Make a task for each page, which can be awaited like the original one."""
+        return {PipelinedTask(self, index): (page_id, input_files)
+                for index, (_, page_id, input_files) in enumerate(self.tasks)}
+
+    def result(self, index):
+        """Await the page at ``index``, after computing the next ``pages`` pages."""
+        while self.computed <= min(index + self.pages, len(self.tasks) - 1):
+            self._compute(self.computed)
+            self.computed += 1
+        queued = self.queued.pop(index)
+        error = self.errors.pop(index, None)
+        if error is not None:
+            raise error
+        # encode all images before touching anything
+        queued = [(file_grp, content.result() if isinstance(content, Future) else content, kwargs)
+                  for file_grp, content, kwargs in queued]
+        for file_grp, content, kwargs in queued:
+            self.add_file_(file_grp, content=content, **kwargs)
+            self.processor.logger.info("created file ID: %s, file_grp: %s, path: %s",
+                                       kwargs['file_id'], file_grp, kwargs['local_filename'])
+
+    def _compute(self, index):
+        if index + 1 < len(self.tasks):
+            _, page_id, input_files = self.tasks[index + 1]
+            path = self._local_path(input_files[0])
+            if path and input_files[0].mimetype == MIMETYPE_PAGE:
+                self.prefetched[page_id] = self.reader.submit(
+                    read_page, path, os.path.abspath(self.workspace.directory), **self.image_filter)
+        task, page_id, _ = self.tasks[index]
+        self.current = index
+        self.queued[index] = []
+        self.prefetch = self.prefetched.pop(page_id, None)
+        try:
+            task.result()
+        except Exception as err: # pylint: disable=broad-except
+            # report when this page gets awaited
+            self.errors[index] = err
+        finally:
+            self.current = None
+            # unless already used
+            self.prefetch = None
+
+    def _local_path(self, input_file):
+        """Resolve the local file of ``input_file`` (if any) independent of the working directory."""
+        if input_file is None or not input_file.local_filename:
+            return None
+        return os.path.abspath(os.path.join(self.workspace.directory, input_file.local_filename))
+
+    def _prefetched(self) -> dict:
+        """Wait until the page being computed has been parsed and decoded ahead (if at all)."""
+        if self.prefetch is None or self.prefetch.exception() is not None:
+            # errors get reported by the processor itself
+            return {}
+        return self.prefetch.result()
+
+    def page_from_file(self, input_file, **kwargs):
+        """Parse ``input_file`` like ``page_from_file``, unless it has been parsed ahead."""
+        prefetched = self._prefetched()
+        if prefetched.get('path') == self._local_path(input_file) and 'pcgts' in prefetched:
+            return prefetched.pop('pcgts')
+        return self.page_from_file_(input_file, **kwargs)
+
+    def apply_mets_file(self, filename_or_url, fun):
+        """Open an image file for ``image_from_page``, unless it has been decoded ahead."""
+        if fun is Image.open:
+            image = self._prefetched().get('images', {}).pop(filename_or_url, None)
+            if image is not None:
+                return image
+        return self.apply_mets_file_(filename_or_url, fun)
+
+    def add_file(self, file_grp, content=None, **kwargs):
+        """Queue ``Workspace.add_file`` for the page being computed."""
+        if self.current is None:
+            return self.add_file_(file_grp, content=content, **kwargs)
+        self.queued[self.current].append((file_grp, content, kwargs))
+        return None
+
+    def save_image_file(self, image, file_id, file_grp, file_path=None, page_id=None,
+                        mimetype='image/png', force=False):
+        """Queue ``Workspace.save_image_file`` for the page being computed, encoding in the background."""
+        def encode():
+            saveargs = {}
+            if 'dpi' in image.info:
+                saveargs['dpi'] = image.info['dpi']
+            # like Pillow>=11.1 does (e.g. for compress_level)
+            saveargs.update(getattr(image, 'encoderinfo', {}))
+            data = io.BytesIO()
+            image.save(data, format=MIME_TO_PIL[mimetype], **saveargs)
+            return data.getvalue()
+        if file_path is None:
+            file_path = str(Path(file_grp, '%s%s' % (file_id, MIME_TO_EXT[mimetype])))
+        content = self.writer.submit(encode)
+        if self.current is None:
+            content = content.result()
+        self.add_file(file_grp, content=content, file_id=file_id, page_id=page_id,
+                      local_filename=file_path, mimetype=mimetype, force=force)
+        return file_path
+
+    def shutdown(self):
+        processor_base.page_from_file = self.page_from_file_
+        del self.workspace._apply_mets_file # pylint: disable=protected-access
+        del self.workspace.add_file
+        del self.workspace.save_image_file
+        # (like cancel_futures, which needs Python>=3.9)
+        for future in self.prefetched.values():
+            future.cancel()
+        for queued in self.queued.values():
+            for _, content, _ in queued:
+                if isinstance(content, Future):
+                    content.cancel()
+        self.reader.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+
+class PipelinedTask:
+    """Page task of a :py:class:`PagePipeline` (as awaited by the processor)."""
+
+    def __init__(self, pipeline, index):
+        self.pipeline = pipeline
+        self.index = index
+
+    def result(self):
+        return self.pipeline.result(self.index)
+
+def read_page(path, directory, feature_selector='', feature_filter=''):
+    """Parse the PAGE file at ``path`` and decode the page images which ``image_from_page`` may open.
+
+    Decode the original image and each AlternativeImage of the page matching
+    ``feature_selector`` and ``feature_filter``, as far as they are files in
+    ``directory``. Return a dict with the ``path``, the parsed ``pcgts`` and
+    the decoded ``images`` (by their filename in the PAGE).
+    """
+    pcgts = page_from_file(path)
+    page = pcgts.get_Page()
+    filenames = [page.get_imageFilename()] + [
+        alternative_image.get_filename()
+        for alternative_image in page.get_AlternativeImage()
+        if matches_features(alternative_image, feature_selector, feature_filter)]
+    images = {}
+    for filename in filenames:
+        if not filename or filename in images:
+            continue
+        try:
+            image = Image.open(os.path.join(directory, filename))
+            image.load()
+        except (OSError, ValueError):
+            # let image_from_page report it
+            continue
+        images[filename] = image
+    return dict(path=path, pcgts=pcgts, images=images)
+
+class PipelinedProcessor(Processor):
+    """Processor which can overlap page I/O with computation.
+
+    If the parameter ``pipeline_pages`` is positive and pages are processed
+    sequentially, run them through a :py:class:`PagePipeline`. Subclasses
+    must retrieve their page images via :py:meth:`_image_from_page`, so the
+    pipeline decodes the right images ahead.
+    """
+
+    def _page_image_filter(self) -> dict:
+        """Keyword arguments of ``image_from_page`` for the input pages."""
+        return dict(feature_filter='binarized')
+
+    def _image_from_page(self, page, page_id):
+        """Get the image of ``page`` via ``image_from_page`` with :py:meth:`_page_image_filter`."""
+        return self.workspace.image_from_page(page, page_id, **self._page_image_filter())
+
+    def process_workspace_handle_tasks(self, tasks):
+        pages = self.parameter['pipeline_pages']
+        if pages <= 0 or any(isinstance(task, Future) for task in tasks):
+            # page-parallel processing overlaps I/O already
+            return super().process_workspace_handle_tasks(tasks)
+        pipeline = PagePipeline(self, tasks, pages, self._page_image_filter())
+        try:
+            return super().process_workspace_handle_tasks(pipeline.page_tasks())
+        finally:
+            pipeline.shutdown()
@@ -1,12 +1,26 @@
 from __future__ import absolute_import
 
 import os.path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import reduce
+from io import BytesIO
+import hashlib
+import importlib
+import math
+import re
+import resource
+import shlex
+import shutil
+import signal
 from tempfile import TemporaryDirectory
-from typing import Optional
+from typing import List, Optional, Union
 import subprocess
+import threading
+import time
 from PIL import Image
 
-from ocrd import Processor, OcrdPageResult, OcrdPageResultImage
+from ocrd import OcrdPageResult, OcrdPageResultImage
 from ocrd_utils import (
     MIME_TO_PIL,
     MIME_TO_EXT
@@ -17,7 +31,277 @@ from ocrd_models.ocrd_page import (
     OcrdPage,
 )
 
-class ShellPreprocessor(Processor):
+from .pipeline import PipelinedProcessor
+from .utils import iter_segments, page_workers
+
+# PIL save options for intermediate images which avoid compression
+# (but still yield valid files of the respective format)
+FAST_ENCODING = {
+    'image/png': {'compress_level': 0},
+    'image/tiff': {'compression': 'raw'},
+}
+
+def encode_image(image, fileobj, mimetype, fast=True):
+    """Save ``image`` to ``fileobj`` in the format of ``mimetype``.
+
+    If ``fast``, then avoid compression where the format allows it.
+    """
+    options = FAST_ENCODING.get(mimetype, {}) if fast else {}
+    image.save(fileobj, format=MIME_TO_PIL[mimetype], **options)
+
+# anything the shell would interpret besides (double) quotes and whitespace
+SHELL_SYNTAX = re.compile(r'[|&;<>()$`\\*?[\]{}~!#\n]')
+
+def split_command(command) -> Optional[List[str]]:
+    """Parse ``command`` into an argument list that can be run without a shell.
+
+    Return None if it contains any shell syntax (like pipes, redirection,
+    variable expansion or globbing) or cannot be parsed (like unbalanced
+    quotes), so it must be passed to the shell.
+    """
+    if SHELL_SYNTAX.search(re.sub(r"'[^']*'", "", command)):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        # let the shell report the syntax error
+        return None
+    if not argv or '=' in argv[0]:
+        # empty or with variable assignment
+        return None
+    return argv
+
+# util-linux tool which applies resource limits before executing a command
+PRLIMIT = shutil.which('prlimit')
+
+def limit_command(command, cputime=0, memory=0) -> List[str]:
+    """Wrap ``command`` (run in the shell if it is a string) in the ``prlimit`` tool.
+
+    Limit CPU time to ``cputime`` seconds and virtual memory to ``memory`` MB
+    (unless zero) before the command gets executed, so the limits are inherited
+    by all processes it starts. (Unlike a ``preexec_fn``, this is safe while other
+    threads are running. The process ID stays the same. Needs util-linux.)
+    """
+    options = []
+    if cputime:
+        # soft limit sends SIGXCPU, hard limit SIGKILL
+        options.append('--cpu=%d:%d' % (math.ceil(cputime), math.ceil(cputime) + 1))
+    if memory:
+        options.append('--as=%d' % int(memory * 1024 * 1024))
+    if isinstance(command, str):
+        command = ['/bin/sh', '-c', command]
+    return [PRLIMIT] + options + ['--'] + command
+
+def limit_resources(pid, cputime=0, memory=0):
+    """Set resource limits on the running process ``pid``.
+
+    Limit CPU time to ``cputime`` seconds and virtual memory to ``memory`` MB
+    (unless zero). (Only a fallback for :py:func:`limit_command` without the
+    ``prlimit`` tool: this races with the process, which may already have used
+    resources or started other processes, which remain unlimited, before the
+    limits apply. Needs Linux.)
+    """
+    try:
+        if cputime:
+            # soft limit sends SIGXCPU, hard limit SIGKILL
+            resource.prlimit(pid, resource.RLIMIT_CPU, (math.ceil(cputime), math.ceil(cputime) + 1))
+        if memory:
+            memory_bytes = int(memory * 1024 * 1024)
+            resource.prlimit(pid, resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    except ProcessLookupError:
+        # finished already
+        pass
+
+def extend_cputime(pid, cputime):
+    """Allow the running process ``pid`` another ``cputime`` seconds of CPU time from now.
+
+    (Only the soft limit is raised, which sends SIGXCPU, because raising the
+    hard limit needs privileges. Needs Linux.)
+    """
+    with open('/proc/%d/stat' % pid) as stat:
+        # utime and stime in clock ticks (fields 14 and 15, counting after the command name)
+        fields = stat.read().rpartition(')')[2].split()
+    used = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    _, hard = resource.prlimit(pid, resource.RLIMIT_CPU)
+    soft = math.ceil(used + cputime)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.prlimit(pid, resource.RLIMIT_CPU, (soft, hard))
+
+class Coprocess:
+    """Long-lived shell command exchanging images over its stdin/stdout.
+
+    Each image is framed as a line with its size in bytes (in ASCII decimal),
+    followed by exactly that many bytes of encoded image data. The command
+    must answer every input frame with exactly one output frame (where an
+    empty frame signals failure).
+
+    The ``limits`` on CPU time and virtual memory (as in :py:func:`limit_command`)
+    apply per answer and for the whole lifetime, respectively.
+    """
+
+    def __init__(self, command, logger, timeout=0, limits=None):
+        self.command = command
+        self.logger = logger
+        self.timeout = timeout
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.process = None
+        self.pid = None
+
+    def start(self):
+        self.logger.debug("Starting coprocess: '%s'", self.command)
+        command = self.command
+        # CPU time gets extended for each answer
+        memory = self.limits[1] if self.limits else 0
+        if memory and PRLIMIT:
+            command = limit_command(command, memory=memory)
+        self.process = subprocess.Popen(command, shell=isinstance(command, str),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        if memory and not PRLIMIT:
+            limit_resources(self.process.pid, memory=memory)
+        # remember owner, so forked page workers will start their own instance
+        self.pid = os.getpid()
+        threading.Thread(target=self._log_stderr, args=(self.process.stderr,),
+                         daemon=True).start()
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.pid == os.getpid():
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.logger.debug("Coprocess returned: %d", self.process.returncode)
+        self.process = None
+
+    def _log_stderr(self, stream):
+        for line in stream:
+            self.logger.warning("Coprocess stderr: %s", line.decode(errors='replace').rstrip())
+
+    def communicate(self, data: bytes, where) -> Optional[bytes]:
+        with self.lock:
+            if self.process is None or self.pid != os.getpid():
+                self.start()
+            timer = None
+            if self.timeout:
+                # kill the coprocess when its answer takes too long
+                timer = threading.Timer(self.timeout, self.process.kill)
+                timer.start()
+            try:
+                if self.limits and self.limits[0]:
+                    extend_cputime(self.process.pid, self.limits[0])
+                self.process.stdin.write(b'%d\n' % len(data))
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+                header = self.process.stdout.readline()
+                if not header:
+                    raise EOFError("no output frame")
+                size = int(header)
+                result = self.process.stdout.read(size)
+                if len(result) < size:
+                    raise EOFError("truncated output frame")
+            except (OSError, ValueError, EOFError) as err:
+                if timer and not timer.is_alive():
+                    self.logger.error("Coprocess for %s timed out after %gs", where, self.timeout)
+                else:
+                    self.logger.error("Coprocess for %s broke down: %s", where, err)
+                # restart on next call
+                self.process.kill()
+                self.process.wait()
+                self.process = None
+                return None
+            finally:
+                if timer:
+                    timer.cancel()
+        return result
+
+
+class ResultCache:
+    """On-disk cache of output images, keyed by a hash of the input image and command.
+
+    Entries are stored as (uncompressed) TIFF files named by their key. When the
+    total size exceeds ``max_size`` (in bytes), the least recently used entries
+    (by modification time, which gets updated on every hit) are removed.
+    Failing to store an entry (e.g. on a full disk) is only logged via ``logger``.
+    """
+
+    def __init__(self, directory, max_size, salt: str, logger):
+        self.directory = directory
+        self.logger = logger
+        self.max_size = max_size
+        self.salt = salt.encode('utf-8')
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, image) -> str:
+        digest = hashlib.sha256(self.salt)
+        digest.update(('\n%s %dx%d\n' % (image.mode, image.width, image.height)).encode('utf-8'))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, key + '.tif')
+
+    def get(self, key) -> Optional[Image.Image]:
+        path = self.path(key)
+        try:
+            image = Image.open(path)
+            image.load()
+        except OSError:
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted meanwhile (by another thread or page worker)
+            pass
+        return image
+
+    def put(self, key, image):
+        path = self.path(key)
+        # write atomically (concurrent threads or page workers may share entries)
+        tmp_path = '%s.%d-%d.tmp' % (path, os.getpid(), threading.get_ident())
+        # keep the resolution, so a hit yields the same output file as a miss
+        options = {'dpi': image.info['dpi']} if 'dpi' in image.info else {}
+        try:
+            image.save(tmp_path, format='TIFF', **options)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            self.logger.warning("Cannot add result to cache: %s", err)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.tif'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # evicted meanwhile (by another page worker)
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class ShellPreprocessor(PipelinedProcessor):
 
     @property
     def executable(self):
@@ -25,10 +309,80 @@ class ShellPreprocessor(Processor):
 
     def setup(self):
         command = self.parameter['command']
-        if '@INFILE' not in command:
-            raise Exception("command parameter requires @INFILE pattern")
-        if '@OUTFILE' not in command:
-            raise Exception("command parameter requires @OUTFILE pattern")
+        self.coprocess = None
+        self.batch = False
+        self.io_times = []
+        self.max_procs = page_workers(self.parameter['max_procs'])
+        self.function = None
+        if self.parameter['callable']:
+            if self.parameter['coprocess']:
+                raise Exception("callable parameter and coprocess parameter are mutually exclusive")
+            self.function = self._import_callable(self.parameter['callable'])
+            command = self.parameter['callable']
+            if not self.parameter['callable_threads']:
+                # the function need not be thread-safe
+                self.max_procs = 1
+        elif not command:
+            raise Exception("command parameter or callable parameter required")
+        self.cache = None
+        if self.parameter['cache_dir']:
+            # normalize command template and mimetypes
+            salt = self._substitute(command, {pattern: pattern for pattern in [
+                '@INFILE', '@OUTFILE', '@INDIR', '@OUTDIR', '@STDIN', '@STDOUT']})
+            salt = ' '.join(salt.split() + [self.parameter['input_mimetype'],
+                                            self.parameter['output_mimetype']])
+            self.cache = ResultCache(self.parameter['cache_dir'],
+                                     self.parameter['cache_size'] * 1024 * 1024, salt,
+                                     self.logger)
+        if self.function:
+            return
+        self.limits = None
+        if self.parameter['max_cputime'] or self.parameter['max_memory']:
+            if hasattr(resource, 'prlimit'):
+                self.limits = (self.parameter['max_cputime'], self.parameter['max_memory'])
+                if not PRLIMIT:
+                    self.logger.warning("prlimit tool not found, so max_cputime and max_memory only "
+                                        "apply shortly after each command started")
+            else:
+                self.logger.warning("max_cputime and max_memory are not supported on this platform")
+        # avoid an extra shell process if possible
+        self.argv = split_command(command)
+        if self.argv is None:
+            self.logger.debug("Running command via shell")
+        if self.parameter['coprocess']:
+            self.coprocess = Coprocess(self.argv or command, self.logger,
+                                       timeout=self.parameter['timeout'],
+                                       limits=self.limits)
+            self.coprocess.start()
+            return
+        self.batch = '@INDIR' in command
+        if self.batch:
+            if '@OUTDIR' not in command:
+                raise Exception("command parameter requires @OUTDIR pattern along with @INDIR")
+            return
+        if '@INFILE' not in command and '@STDIN' not in command:
+            raise Exception("command parameter requires @INFILE or @STDIN pattern")
+        if '@OUTFILE' not in command and '@STDOUT' not in command:
+            raise Exception("command parameter requires @OUTFILE or @STDOUT pattern")
+
+    @staticmethod
+    def _import_callable(reference):
+        module_name, _, function_name = reference.partition(':')
+        if not module_name or not function_name:
+            raise Exception("callable parameter must be of the form 'module:function'")
+        module = importlib.import_module(module_name)
+        function = reduce(getattr, function_name.split('.'), module)
+        if not callable(function):
+            raise Exception("callable parameter '%s' is not callable" % reference)
+        return function
+
+    def shutdown(self):
+        if getattr(self, 'coprocess', None):
+            self.coprocess.stop()
+
+    def _page_image_filter(self):
+        return dict(feature_filter=self.parameter['input_feature_filter'],
+                    feature_selector=self.parameter['input_feature_selector'])
 
     def process_page_pcgts(self, *input_pcgts: Optional[OcrdPage], page_id: Optional[str] = None) -> OcrdPageResult:
         """Performs coords-preserving image operations via runtime shell calls anywhere.
@@ -54,6 +408,44 @@ class ShellPreprocessor(Processor):
         after replacing:
         - the string ``@INFILE`` with that input image path, and
         - the string ``@OUTFILE`` with that output image path.
+        (If ``command`` contains ``@STDIN`` and/or ``@STDOUT`` instead,
+        then replace these with ``/dev/stdin`` and ``/dev/stdout``, and pass
+        the input image via the shell's standard input and/or read the output
+        image from its standard output, avoiding temporary files altogether.
+        Otherwise, temporary files are placed under ``tmpdir``.)
+
+        (If ``callable`` is set, then instead of running any shell ``command``,
+        call that Python function in-process on the image, and use its result.
+        Unless ``callable_threads`` is enabled, call it on one image at a time.)
+
+        (If ``coprocess`` is enabled, then instead pass the image to the
+        ``command`` running in the background since ``setup``, and read back
+        its result, both over its standard streams. Then ``timeout`` and
+        ``max_cputime`` apply to each answer rather than the whole process.)
+
+        (If ``command`` contains ``@INDIR`` and ``@OUTDIR``, then instead
+        write the images of all segments of the page into one temporary
+        directory, named by their segment ID, and run ``command`` only once,
+        after replacing these patterns with the input and output directory
+        paths. Then look up each segment's result in the output directory by
+        the same name, with the extension for ``output_mimetype``.)
+
+        (Unless ``fast_encoding`` is disabled, save input images without
+        compression where ``input_mimetype`` allows it, i.e. PNG with
+        compression level 0 and raw TIFF. This does not affect the final
+        output images.)
+
+        (If ``command`` does not need a shell, i.e. contains no shell syntax
+        besides quotation, then parse it into an argument list once and run
+        it directly. Either way, kill the command when it exceeds ``timeout``,
+        ``max_cputime`` or ``max_memory``, and treat that as failure.)
+
+        (Unless ``max_procs`` is 1, run up to that many commands concurrently,
+        but keep results in document order.)
+
+        (If ``cache_dir`` is set, then first look up the result in the cache
+        under a hash of the image and command, and if found, use it instead
+        of running the command. Otherwise add the result to the cache.)
 
         If the shell returns with a failure, skip that segment with an
         approriate error message.
@@ -64,6 +456,11 @@ class ShellPreprocessor(Processor):
         Reference it as AlternativeImage in the element,
         adding ``output_feature_added`` to its @comments.
 
+        (If ``pipeline_pages`` is non-zero and pages are processed sequentially,
+        then parse and decode the next page's input while running the command on
+        the current one, and encode the result images of up to that many pages
+        in the background.)
+
         Produce a new PAGE output file by serialising the resulting hierarchy.
         """
         pcgts = input_pcgts[0]
@@ -73,113 +470,103 @@ class ShellPreprocessor(Processor):
         feature_selector = self.parameter['input_feature_selector']
         feature_filter = self.parameter['input_feature_filter']
 
-        page_image, page_coords, _ = self.workspace.image_from_page(
-            page, page_id,
-            feature_filter=feature_filter, feature_selector=feature_selector)
-        if oplevel == 'page':
-            image = self._process_segment(
-                page, page_image, page_coords, "page '%s'" % page_id)
-            if image:
-                result.images.append(image)
-            return result
-
-        regions = page.get_AllRegions(classes=['Text'])
-        if not regions:
-            self.logger.warning("Page '%s' contains no text regions", page_id)
-        for region in regions:
-            region_image, region_coords = self.workspace.image_from_segment(
-                region, page_image, page_coords,
-                feature_filter=feature_filter, feature_selector=feature_selector)
-            if oplevel == 'region':
-                image = self._process_segment(
-                    region, region_image, region_coords, "region '%s'" % region.id)
-                if image:
-                    result.images.append(image)
-                continue
-
-            lines = region.get_TextLine()
-            if not lines:
-                self.logger.warning("Region '%s' contains no text lines", region.id)
-            for line in lines:
-                line_image, line_coords = self.workspace.image_from_segment(
-                    line, region_image, region_coords,
-                    feature_filter=feature_filter, feature_selector=feature_selector)
-                if oplevel == 'line':
-                    image = self._process_segment(
-                        line, line_image, line_coords, "line '%s'" % line.id)
-                    if image:
-                        result.images.append(image)
-                    continue
+        page_image, page_coords, _ = self._image_from_page(page, page_id)
+        segments = []
+        for segment, segment_image, segment_coords in iter_segments(
+                self.workspace, self.logger, page, page_id, page_image, page_coords, oplevel,
+                feature_filter=feature_filter, feature_selector=feature_selector):
+            where = "page '%s'" % page_id if oplevel == 'page' else "%s '%s'" % (oplevel, segment.id)
+            segments.append((segment, segment_image, segment_coords, where))
+        result.images.extend(self._process_segments(segments, page_id))
+        return result
 
-                words = line.get_Word()
-                if not words:
-                    self.logger.warning("Line '%s' contains no words", line.id)
-                for word in words:
-                    word_image, word_coords = self.workspace.image_from_segment(
-                        word, line_image, line_coords,
-                        feature_filter=feature_filter, feature_selector=feature_selector)
-                    if oplevel == 'word':
-                        image = self._process_segment(
-                            word, word_image, word_coords, "word '%s'" % word.id)
-                        if image:
-                            result.images.append(image)
-                        continue
+    def _process_segments(self, segments, page_id) -> List[OcrdPageResultImage]:
+        self.io_times = []
+        outputs = [None] * len(segments)
+        pending = list(range(len(segments)))
+        if self.cache:
+            keys = [self.cache.key(image) for _, image, _, _ in segments]
+            outputs = [self.cache.get(key) for key in keys]
+            pending = [i for i, output in enumerate(outputs) if output is None]
+            self.logger.info("Cache for page '%s': %d hits, %d misses",
+                             page_id, len(segments) - len(pending), len(pending))
+        todo = [segments[i] for i in pending]
+        if self.batch:
+            results = self._run_batch(todo, page_id)
+        elif self.max_procs > 1 and len(todo) > 1:
+            # run commands concurrently, but keep results in document order
+            with ThreadPoolExecutor(max_workers=self.max_procs) as executor:
+                results = list(executor.map(lambda segment: self._run_segment(*segment), todo))
+        else:
+            results = [self._run_segment(*segment) for segment in todo]
+        for i, image2 in zip(pending, results):
+            outputs[i] = image2
+            if self.cache and image2 is not None and image2.size == segments[i][1].size:
+                self.cache.put(keys[i], image2)
+        if self.cache and pending:
+            self.cache.evict()
+        if self.io_times:
+            self.logger.info("Image I/O for page '%s' took %.3fs for %d segments",
+                             page_id, sum(self.io_times), len(self.io_times))
+        images = [self._add_result(segment, image, image2, coords, where)
+                  for (segment, image, coords, where), image2 in zip(segments, outputs)]
+        return [image for image in images if image]
 
-                    glyphs = word.get_Glyph()
-                    if not glyphs:
-                        self.logger.warning("Word '%s' contains no glyphs", word.id)
-                    for glyph in glyphs:
-                        glyph_image, glyph_coords = self.workspace.image_from_segment(
-                            glyph, word_image, word_coords,
-                            feature_filter=feature_filter, feature_selector=feature_selector)
-                        image = self._process_segment(
-                            glyph, glyph_image, glyph_coords, "glyph '%s'" % glyph.id)
-                        if image:
-                            result.images.append(image)
-        return result
+    def _run_segment(self, segment, image, coords, where) -> Optional[Image.Image]:
+        if self.function:
+            return self._run_callable(image, where)
+        if self.coprocess:
+            return self._run_coprocess(image, where)
+        return self._run_command(segment, image, where)
 
-    def _process_segment(self, segment, image, coords, where) -> Optional[OcrdPageResultImage]:
+    def _run_batch(self, segments, page_id) -> List[Optional[Image.Image]]:
+        if not segments:
+            return []
+        input_mime = self.parameter['input_mimetype']
+        output_mime = self.parameter['output_mimetype']
+        with TemporaryDirectory(suffix=page_id, dir=self.parameter['tmpdir'] or None) as tmpdir:
+            in_dir = os.path.join(tmpdir, 'in')
+            out_dir = os.path.join(tmpdir, 'out')
+            os.mkdir(in_dir)
+            os.mkdir(out_dir)
+            names = []
+            start = time.perf_counter()
+            for segment, image, _, _ in segments:
+                name = 'page' if isinstance(segment, PageType) else segment.id
+                names.append(name)
+                # save retrieved segment image to temporary file
+                with open(os.path.join(in_dir, name + MIME_TO_EXT[input_mime]), 'wb') as in_file:
+                    encode_image(image, in_file, input_mime, self.parameter['fast_encoding'])
+            encoding = time.perf_counter() - start
+            command = self._prepare_command({'@INDIR': in_dir, '@OUTDIR': out_dir})
+            if self._execute(command, "page '%s' (%d segments)" % (page_id, len(segments))) is None:
+                return [None] * len(segments)
+            results = []
+            start = time.perf_counter()
+            for (_, _, _, where), name in zip(segments, names):
+                out_path = os.path.join(out_dir, name + MIME_TO_EXT[output_mime])
+                if not os.path.exists(out_path):
+                    self.logger.error("Command for %s produced no image", where)
+                    results.append(None)
+                    continue
+                image2 = Image.open(out_path)
+                image2.load()
+                results.append(image2)
+            self._log_io("page '%s'" % page_id, encoding, time.perf_counter() - start)
+        return results
+
+    def _add_result(self, segment, image, image2, coords, where) -> Optional[OcrdPageResultImage]:
+        if image2 is None:
+            return None
+        # check resulting image
+        if image.size != image2.size:
+            self.logger.error("Command for %s produced image of different size (%s vs %s)",
+                              where, str(image.size), str(image2.size))
+            return None
         features = coords['features'] # features already applied to image
         feature_added = self.parameter['output_feature_added']
         if feature_added:
             features += ',' + feature_added
-        command = self.parameter['command']
-        input_mime = self.parameter['input_mimetype']
-        output_mime = self.parameter['output_mimetype']
-        in_fname = "in" + MIME_TO_EXT[input_mime]
-        out_fname = "out" + MIME_TO_EXT[output_mime]
-        with TemporaryDirectory(suffix=segment.id) as tmpdir:
-            in_path = os.path.join(tmpdir, in_fname)
-            out_path = os.path.join(tmpdir, out_fname)
-            # save retrieved segment image to temporary file
-            with open(in_path, 'wb') as in_file:
-                image.save(in_file, format=MIME_TO_PIL[input_mime])
-            # remove quotation around filename patterns, if any
-            command = command.replace('"@INFILE"', '@INFILE').replace('"@OUTFILE"', '@OUTFILE')
-            command = command.replace("'@INFILE'", '@INFILE').replace("'@OUTFILE'", '@OUTFILE')
-            # replace filename patterns with actual paths, quoted
-            command = command.replace('@INFILE', '"' + in_path + '"').replace('@OUTFILE', '"' + out_path + '"')
-            # execute command pattern
-            self.logger.debug("Running command: '%s'", command)
-            # pylint: disable=subprocess-run-check
-            result = subprocess.run(command, shell=True,
-                                    universal_newlines=True,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            self.logger.debug("Command for %s returned: %d", where, result.returncode)
-            if result.stdout:
-                self.logger.info("Command for %s stdout: %s", where, result.stdout)
-            if result.stderr:
-                self.logger.warning("Command for %s stderr: %s", where, result.stderr)
-            if result.returncode != 0:
-                self.logger.error("Command for %s failed", where)
-                return None
-            image2 = Image.open(out_path)
-            # check resulting image
-            if image.size != image2.size:
-                self.logger.error("Command for %s produced image of different size (%s vs %s)",
-                                  where, str(image.size), str(image2.size))
-                return None
         # update PAGE (reference the image file):
         image_ref = AlternativeImageType(comments=features)
         segment.add_AlternativeImage(image_ref)
@@ -189,3 +576,140 @@ class ShellPreprocessor(Processor):
             suffix + '.IMG-' + feature_added.upper().replace(',', '-'),
             image_ref
         )
+
+    def _run_command(self, segment, image, where) -> Optional[Image.Image]:
+        command = self.parameter['command']
+        input_mime = self.parameter['input_mimetype']
+        output_mime = self.parameter['output_mimetype']
+        in_fname = "in" + MIME_TO_EXT[input_mime]
+        out_fname = "out" + MIME_TO_EXT[output_mime]
+        stdin = '@STDIN' in command
+        stdout = '@STDOUT' in command
+        if stdin and stdout:
+            tmpdir = nullcontext('')
+        else:
+            tmpdir = TemporaryDirectory(suffix=segment.id, dir=self.parameter['tmpdir'] or None)
+        with tmpdir as tmpdir:
+            in_path = os.path.join(tmpdir, in_fname)
+            out_path = os.path.join(tmpdir, out_fname)
+            start = time.perf_counter()
+            if stdin:
+                data = BytesIO()
+                encode_image(image, data, input_mime, self.parameter['fast_encoding'])
+                data = data.getvalue()
+            else:
+                data = None
+                # save retrieved segment image to temporary file
+                with open(in_path, 'wb') as in_file:
+                    encode_image(image, in_file, input_mime, self.parameter['fast_encoding'])
+            encoding = time.perf_counter() - start
+            command = self._prepare_command({'@INFILE': in_path, '@OUTFILE': out_path,
+                                             '@STDIN': '/dev/stdin', '@STDOUT': '/dev/stdout'})
+            output = self._execute(command, where, data=data, capture=stdout)
+            if output is None:
+                return None
+            start = time.perf_counter()
+            image2 = Image.open(BytesIO(output) if stdout else out_path)
+            image2.load()
+            decoding = time.perf_counter() - start
+        self._log_io(where, encoding, decoding)
+        return image2
+
+    @staticmethod
+    def _substitute(command, patterns) -> str:
+        for pattern, path in patterns.items():
+            # remove quotation around pattern, if any
+            command = command.replace('"' + pattern + '"', pattern).replace("'" + pattern + "'", pattern)
+            # replace pattern with actual path, quoted
+            command = command.replace(pattern, '"' + path + '"')
+        return command
+
+    def _prepare_command(self, patterns) -> Union[str, List[str]]:
+        if self.argv is None:
+            return self._substitute(self.parameter['command'], patterns)
+        argv = []
+        for arg in self.argv:
+            for pattern, path in patterns.items():
+                arg = arg.replace(pattern, path)
+            argv.append(arg)
+        return argv
+
+    def _execute(self, command, where, data=None, capture=False) -> Optional[bytes]:
+        """Run ``command`` (in the shell if it is a string), passing ``data`` as its standard input.
+
+        Return its standard output (which is only logged unless ``capture``),
+        or None if it failed, timed out or exceeded its resource limits.
+        """
+        timeout = self.parameter['timeout'] or None
+        # execute command pattern
+        if isinstance(command, str):
+            self.logger.debug("Running command: '%s'", command)
+        else:
+            self.logger.debug("Running command: '%s'", shlex.join(command))
+        if self.limits and PRLIMIT:
+            command = limit_command(command, *self.limits)
+        try:
+            process = subprocess.Popen(command, shell=isinstance(command, str),
+                                       stdin=subprocess.PIPE if data is not None else None,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       # allow killing all descendants
+                                       start_new_session=bool(timeout))
+        except OSError as err:
+            self.logger.error("Command for %s failed: %s", where, err)
+            return None
+        if self.limits and not PRLIMIT:
+            limit_resources(process.pid, *self.limits)
+        try:
+            stdout, stderr = process.communicate(data, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.communicate()
+            self.logger.error("Command for %s timed out after %gs", where, timeout)
+            return None
+        self.logger.debug("Command for %s returned: %d", where, process.returncode)
+        if stdout and not capture:
+            self.logger.info("Command for %s stdout: %s", where, stdout.decode(errors='replace'))
+        if stderr:
+            self.logger.warning("Command for %s stderr: %s", where, stderr.decode(errors='replace'))
+        if process.returncode < 0:
+            self.logger.error("Command for %s was killed by signal %d", where, -process.returncode)
+            return None
+        if process.returncode != 0:
+            self.logger.error("Command for %s failed", where)
+            return None
+        return stdout
+
+    def _log_io(self, where, encoding, decoding):
+        self.logger.debug("Image I/O for %s took %.1fms (encoding) + %.1fms (decoding)",
+                          where, 1000 * encoding, 1000 * decoding)
+        self.io_times.append(encoding + decoding)
+
+    def _run_callable(self, image, where) -> Optional[Image.Image]:
+        self.logger.debug("Calling %s for %s", self.parameter['callable'], where)
+        try:
+            image2 = self.function(image)
+        except Exception as err: # pylint: disable=broad-except
+            self.logger.error("Callable for %s failed: %s", where, err)
+            return None
+        if not isinstance(image2, Image.Image):
+            self.logger.error("Callable for %s returned no image but %s", where, type(image2).__name__)
+            return None
+        return image2
+
+    def _run_coprocess(self, image, where) -> Optional[Image.Image]:
+        input_mime = self.parameter['input_mimetype']
+        start = time.perf_counter()
+        data = BytesIO()
+        encode_image(image, data, input_mime, self.parameter['fast_encoding'])
+        encoding = time.perf_counter() - start
+        self.logger.debug("Sending %s to coprocess", where)
+        result = self.coprocess.communicate(data.getvalue(), where)
+        if not result:
+            self.logger.error("Command for %s failed", where)
+            return None
+        start = time.perf_counter()
+        image2 = Image.open(BytesIO(result))
+        image2.load()
+        self._log_io(where, encoding, time.perf_counter() - start)
+        return image2
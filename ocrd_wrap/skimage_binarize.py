@@ -1,35 +1,204 @@
 from __future__ import absolute_import
 
 import os.path
-from typing import Optional
+from typing import List, Optional
 from PIL import Image
 import numpy as np
 from skimage.filters import (
-    threshold_niblack,
-    threshold_li,
     threshold_local,
     threshold_otsu,
-    threshold_sauvola,
     threshold_yen
 )
+from skimage.transform import integral_image
 
-from ocrd import Processor, OcrdPageResult, OcrdPageResultImage
+from ocrd import OcrdPageResult, OcrdPageResultImage
 from ocrd_models.ocrd_page import (
     AlternativeImageType,
     PageType,
     OcrdPage,
 )
 
+from .pipeline import PipelinedProcessor
+from .utils import (
+    check_png_compression,
+    crop_page_array,
+    iter_segments,
+    map_segments,
+    page_workers,
+    png_compression,
+    process_tiled,
+)
+
+# methods with a threshold surface (instead of a global threshold)
+LOCAL_METHODS = ['sauvola', 'niblack', 'gauss']
 
 def odd(n):
     return int(n) + int((n+1)%2)
 
-class SkimageBinarize(Processor):
+def window_mean(array, window_size):
+    """Mean in a square window of ``window_size`` around each pixel of float ``array``.
+
+    Use integral images, reflecting at the borders (like skimage's Sauvola/Niblack).
+    """
+    height, width = array.shape
+    half = window_size // 2
+    padded = np.pad(array, ((half + 1, half),) * 2, mode='reflect')
+    integral = integral_image(padded, dtype=np.float64)
+    total = integral[:height, :width].copy()
+    total -= integral[:height, window_size:window_size + width]
+    total -= integral[window_size:window_size + height, :width]
+    total += integral[window_size:window_size + height, window_size:window_size + width]
+    total /= window_size * window_size
+    return total
+
+def block_mean(array, factor):
+    """Downsample float ``array`` by averaging blocks of ``factor`` x ``factor`` pixels."""
+    height, width = array.shape
+    padded = np.pad(array, ((0, -height % factor), (0, -width % factor)), mode='edge')
+    return padded.reshape(padded.shape[0] // factor, factor,
+                          padded.shape[1] // factor, factor).mean(axis=(1, 3))
+
+def upsample(array, factor, shape):
+    """Upsample block-wise ``array`` by ``factor`` to ``shape`` with bilinear interpolation."""
+    for axis, size in enumerate(shape):
+        # position of each full-resolution pixel center in block coordinates
+        pos = np.clip((np.arange(size) - (factor - 1) / 2) / factor, 0, array.shape[axis] - 1)
+        lower = np.floor(pos).astype(int)
+        upper = np.minimum(lower + 1, array.shape[axis] - 1)
+        weight = pos - lower
+        if axis == 0:
+            weight = weight[:, np.newaxis]
+        array = (np.take(array, lower, axis=axis) * (1 - weight) +
+                 np.take(array, upper, axis=axis) * weight)
+    return array
+
+def threshold_li_hist(hist):
+    """Compute Li's minimum cross entropy threshold from a ``hist`` of integer values.
+
+    Same iteration as ``skimage.filters.threshold_li`` on integer images, but
+    without passes over the pixels for initialization and shifting.
+    """
+    counts, bin_centers = hist
+    image_min = bin_centers[0]
+    if counts.size == 1:
+        return image_min
+    # shift to a positive range, because of log(mean)
+    bin_centers = bin_centers - image_min
+    tolerance = 0.5
+    t_next = np.float64(np.dot(counts, bin_centers)) / counts.sum()
+    t_curr = -2 * tolerance
+    counts = counts.astype('float32', copy=False)
+    while abs(t_next - t_curr) > tolerance:
+        t_curr = t_next
+        foreground = bin_centers > t_curr
+        background = ~foreground
+        mean_fore = np.average(bin_centers[foreground], weights=counts[foreground])
+        mean_back = np.average(bin_centers[background], weights=counts[background])
+        if mean_back == 0:
+            break
+        t_next = (mean_back - mean_fore) / (np.log(mean_back) - np.log(mean_fore))
+    return t_next + image_min
+
+def variant_name(params):
+    """Identify the thresholding variant of ``params`` (for sweep mode)."""
+    method = params['method']
+    if method in ['sauvola', 'niblack']:
+        return '%s-w%d-k%g' % (method, params['window_size'], params['k'])
+    if method == 'gauss':
+        return '%s-w%d' % (method, params['window_size'])
+    return method
+
+class ThresholdStatistics:
+    """Compute thresholds for a grayscale image, sharing intermediate results between variants.
+
+    Local mean and standard deviation (for Sauvola and Niblack) are cached
+    per window size, the histogram (for Otsu, Li and Yen) is computed once
+    by counting values. Results are identical to the respective
+    ``skimage.filters`` functions.
+
+    If ``params`` has a ``decimation`` factor larger than 1, then compute
+    local thresholds on blocks of that size instead, and interpolate
+    the resulting surface bilinearly.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self._mean_std = {}
+        self._histogram = None
+
+    def mean_std(self, window_size, factor=1):
+        """Local mean and standard deviation in a square window of ``window_size``.
+
+        If ``factor`` is larger than 1, then compute them on blocks of that size
+        (from the block means of values and squares, so the variance within
+        blocks is retained).
+        """
+        key = window_size, factor
+        if key not in self._mean_std:
+            array = self.array.astype(np.float64)
+            squares = array * array
+            if factor > 1:
+                array = block_mean(array, factor)
+                squares = block_mean(squares, factor)
+                window_size = odd(window_size / factor)
+            mean = window_mean(array, window_size)
+            mean_sq = window_mean(squares, window_size)
+            std = np.sqrt(np.clip(mean_sq - mean * mean, 0, None))
+            self._mean_std[key] = mean, std
+        return self._mean_std[key]
+
+    def histogram(self):
+        """Counts and values of the (uint8) image, trimmed to its range of values."""
+        if self._histogram is None:
+            counts = np.bincount(self.array.ravel(), minlength=256)
+            values = np.flatnonzero(counts)
+            start, end = values[0], values[-1] + 1
+            self._histogram = counts[start:end], np.arange(start, end)
+        return self._histogram
+
+    def threshold(self, params):
+        """Compute the threshold (scalar or surface) according to ``params``."""
+        method = params['method']
+        if method == 'otsu':
+            counts, bin_centers = self.histogram()
+            if counts.size == 1:
+                # uniform image
+                return bin_centers[0]
+            return threshold_otsu(hist=(counts, bin_centers))
+        if method == 'li':
+            return threshold_li_hist(self.histogram())
+        if method == 'yen':
+            return threshold_yen(hist=self.histogram())
+        factor = params.get('decimation', 1)
+        if method == 'gauss':
+            if factor > 1:
+                thres = threshold_local(block_mean(self.array.astype(np.float64), factor),
+                                        odd(params['window_size'] / factor))
+            else:
+                thres = threshold_local(self.array, params['window_size'])
+        elif method == 'niblack':
+            mean, std = self.mean_std(params['window_size'], factor)
+            thres = mean - params['k'] * std
+        elif method == 'sauvola':
+            mean, std = self.mean_std(params['window_size'], factor)
+            # dynamic range of uint8
+            r = 0.5 * 255
+            thres = mean * (1 + params['k'] * ((std / r) - 1))
+        else:
+            raise ValueError("unknown method '%s'" % method)
+        if factor > 1:
+            thres = upsample(thres, factor, self.array.shape)
+        return thres
+
+class SkimageBinarize(PipelinedProcessor):
 
     @property
     def executable(self):
         return 'ocrd-skimage-binarize'
 
+    def setup(self):
+        check_png_compression(self.logger, self.parameter)
+
     def process_page_pcgts(self, *input_pcgts: Optional[OcrdPage], page_id: Optional[str] = None) -> OcrdPageResult:
         """Performs binarization of segment or page images with scikit-image on the workspace.
 
@@ -44,9 +213,41 @@ class SkimageBinarize(Processor):
 
         Next, binarize the image according to ``method`` with skimage.
 
+        (If ``sweep`` is non-empty, then instead produce one binarized image
+        for each of its variants, overriding ``method``, ``window_size`` and
+        ``k`` respectively. Statistics are shared between variants where
+        possible. Each variant is annotated with an extra feature in the
+        AlternativeImage's comments, e.g. ``sauvola-w301-k0.34``.)
+
+        (If ``decimation`` is larger than 1, then approximate the threshold
+        surface of local methods by computing it on blocks of that many
+        pixels and interpolating bilinearly. If zero, derive the factor
+        from the DPI, so blocks are about 1/150 inch.)
+
+        (If ``tile_memory`` is non-zero, then compute local thresholds in
+        horizontal strips with enough context for the window, so memory
+        use stays within that many MB, with identical results.)
+
+        (If ``page_threshold`` is enabled and operating below the page level
+        with a local method, then compute the threshold surface only once on
+        the page image, and crop it for each segment. Segments which are not
+        plain crops of the page image, e.g. because they got deskewed or
+        have an AlternativeImage of their own, are thresholded separately.)
+
+        (If ``max_threads`` is not 1, then binarize the segments of a page in
+        that many threads concurrently, or in as many as CPU cores are left
+        by page-parallel processing if zero. Results keep document order.)
+
         Then write the new image to the workspace along with the output fileGrp,
         and using a file ID with suffix ``.IMG-BIN`` with further identification
-        of the input element.
+        of the input element. Images are saved as 1-bit PNG. (If ``compress_level``
+        is not -1, then use that zlib level instead of the default, e.g. 1 for
+        faster encoding at slightly larger size.)
+
+        (If ``pipeline_pages`` is non-zero and pages are processed sequentially,
+        then parse and decode the next page's input in the background while
+        binarizing the current one, and encode the result images of up to that
+        many pages in the background as well.)
 
         Produce a new PAGE output file by serialising the resulting hierarchy.
         """
@@ -55,8 +256,7 @@ class SkimageBinarize(Processor):
         page = pcgts.get_Page()
         oplevel = self.parameter['level-of-operation']
 
-        page_image, page_coords, page_image_info = self.workspace.image_from_page(
-            page, page_id, feature_filter='binarized')
+        page_image, page_coords, page_image_info = self._image_from_page(page, page_id)
         if self.parameter['dpi'] > 0:
             dpi = self.parameter['dpi']
             self.logger.info("Page '%s' images will use %d DPI from parameter override", page_id, dpi)
@@ -69,88 +269,103 @@ class SkimageBinarize(Processor):
             dpi = 300
             self.logger.info("Page '%s' images will use 300 DPI from fall-back", page_id)
 
-        params = dict(self.parameter)
-        # guess a useful window size if not given
-        if not params['window_size']:
-            # use 1x1 inch square
-            params['window_size'] = odd(dpi)
-        if not params['k']:
-            params['k'] = 0.34
+        variants = self._variants(dpi)
 
         if oplevel == 'page':
-            image = self._process_segment(page, page_image, page_coords, params)
-            if image:
-                result.images.append(image)
+            result.images.extend(self._process_segment(page, page_image, page_coords, variants))
             return result
 
-        regions = page.get_AllRegions(classes=['Text'])
-        if not regions:
-            self.logger.warning("Page '%s' contains no text regions", page_id)
-        for region in regions:
-            region_image, region_coords = self.workspace.image_from_segment(
-                region, page_image, page_coords, feature_filter='binarized')
-            if oplevel == 'region':
-                image = self._process_segment(region, region_image, region_coords, params)
-                if image:
-                    result.images.append(image)
-                continue
-
-            lines = region.get_TextLine()
-            if not lines:
-                self.logger.warning("Region '%s' contains no text lines", region.id)
-            for line in lines:
-                line_image, line_coords = self.workspace.image_from_segment(
-                    line, region_image, region_coords, feature_filter='binarized')
-                if oplevel == 'line':
-                    image = self._process_segment(line, line_image, line_coords, params)
-                    if image:
-                        result.images.append(image)
-                    continue
+        page_thres = None
+        if self.parameter['page_threshold']:
+            local = [params for params in variants if params['method'] in LOCAL_METHODS]
+            if local:
+                stacked = self._threshold_tiled(np.array(page_image.convert('L')), local, compare=False)
+                stacked = iter(np.moveaxis(stacked, 1, 0))
+            page_thres = [next(stacked) if params['method'] in LOCAL_METHODS else None
+                          for params in variants]
 
-                words = line.get_Word()
-                if not words:
-                    self.logger.warning("Line '%s' contains no words", line.id)
-                for word in words:
-                    word_image, word_coords = self.workspace.image_from_segment(
-                        word, line_image, line_coords, feature_filter='binarized')
-                    if oplevel == 'word':
-                        image = self._process_segment(word, word_image, word_coords, params)
-                        if image:
-                            result.images.append(image)
-                        continue
-
-                    glyphs = word.get_Glyph()
-                    if not glyphs:
-                        self.logger.warning("Word '%s' contains no glyphs", word.id)
-                    for glyph in glyphs:
-                        glyph_image, glyph_coords = self.workspace.image_from_segment(
-                            glyph, word_image, word_coords, feature_filter='binarized')
-                        image = self._process_segment(glyph, glyph_image, glyph_coords, params)
-                        if image:
-                            result.images.append(image)
+        for images in map_segments(
+                lambda segment, segment_image, segment_coords: self._process_segment(
+                    segment, segment_image, segment_coords, variants, page_thres, page_coords),
+                iter_segments(self.workspace, self.logger, page, page_id, page_image, page_coords,
+                              oplevel, feature_filter='binarized'),
+                page_workers(self.parameter['max_threads'])):
+            result.images.extend(images)
         return result
 
-    def _process_segment(self, segment, image, coords, params: dict) -> Optional[OcrdPageResultImage]:
+    def _variants(self, dpi) -> list:
+        """Resolve the parameters of each (sweep) variant for images of ``dpi``."""
+        variants = []
+        for variant in self.parameter['sweep'] or [{}]:
+            params = dict(self.parameter, **variant)
+            # guess a useful window size if not given
+            if not params['window_size']:
+                # use 1x1 inch square
+                params['window_size'] = odd(dpi)
+            if not params['k']:
+                params['k'] = 0.34
+            if not params['decimation']:
+                # use about 150 DPI
+                params['decimation'] = max(1, round(dpi / 150))
+            variants.append(params)
+        return variants
+
+    def _process_segment(self, segment, image, coords, variants: list,
+                         page_thres=None, page_coords=None) -> List[OcrdPageResultImage]:
         features = coords['features'] # features already applied to image
         features += ',binarized'
-        method = params['method']
         array = np.array(image.convert('L'))
-        if method == 'otsu':
-            thres = threshold_otsu(array)
-        elif method == 'li':
-            thres = threshold_li(array)
-        elif method == 'yen':
-            thres = threshold_yen(array)
-        elif method == 'gauss':
-            thres = threshold_local(array, params['window_size'])
-        elif method == 'niblack':
-            thres = threshold_niblack(array, params['window_size'], params['k'])
-        elif method == 'sauvola':
-            thres = threshold_sauvola(array, params['window_size'], params['k'])
-        array = array > thres
-        image = Image.fromarray(array)
-        # update PAGE (reference the image file):
-        image_ref = AlternativeImageType(comments=features)
-        segment.add_AlternativeImage(image_ref)
-        suffix = "" if isinstance(segment, PageType) else segment.id
-        return OcrdPageResultImage(image, suffix + '.IMG-BIN', image_ref)
+        stats = ThresholdStatistics(array)
+        binarized = [None] * len(variants)
+        local = []
+        for i, params in enumerate(variants):
+            if page_thres is not None and page_thres[i] is not None:
+                thres = crop_page_array(page_thres[i], page_coords, coords, array.shape)
+                if thres is not None:
+                    binarized[i] = array > thres
+                    continue
+                self.logger.debug("Segment '%s' is no plain crop of the page, thresholding separately",
+                                  segment.id)
+            if params['method'] in LOCAL_METHODS:
+                local.append(i)
+            else:
+                binarized[i] = array > stats.threshold(params)
+        if local:
+            stacked = self._threshold_tiled(array, [variants[i] for i in local])
+            for j, i in enumerate(local):
+                binarized[i] = np.ascontiguousarray(stacked[:, j])
+        sweep = len(self.parameter['sweep']) > 0
+        results = []
+        for params, array in zip(variants, binarized):
+            image = png_compression(Image.fromarray(array), self.parameter['compress_level'])
+            # update PAGE (reference the image file):
+            suffix = "" if isinstance(segment, PageType) else segment.id
+            suffix += '.IMG-BIN'
+            comments = features
+            if sweep:
+                name = variant_name(params)
+                suffix += '-' + name.upper()
+                comments += ',' + name
+            image_ref = AlternativeImageType(comments=comments)
+            segment.add_AlternativeImage(image_ref)
+            results.append(OcrdPageResultImage(image, suffix, image_ref))
+        return results
+
+    def _threshold_tiled(self, array, variants: list, compare=True):
+        """Compute the local thresholds of all ``variants`` for ``array`` in strips within ``tile_memory``.
+
+        Return the thresholded arrays (if ``compare``) or the threshold surfaces,
+        stacked along axis 1.
+        """
+        def threshold_strip(strip):
+            stats = ThresholdStatistics(strip)
+            if compare:
+                return np.stack([strip > stats.threshold(params) for params in variants], axis=1)
+            return np.stack([stats.threshold(params) for params in variants], axis=1)
+        # context for the window (and interpolation between blocks)
+        halo = max(params['window_size'] + 2 * params['decimation'] for params in variants)
+        # keep block grid for decimation
+        align = int(np.lcm.reduce([params['decimation'] for params in variants]))
+        # several float64 arrays per variant
+        return process_tiled(threshold_strip, array, self.parameter['tile_memory'],
+                             pixel_bytes=64 * len(variants), halo=halo, align=align)
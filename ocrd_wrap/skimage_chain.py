@@ -0,0 +1,165 @@
+from __future__ import absolute_import
+
+from typing import List, Optional
+
+from ocrd import OcrdPageResult, OcrdPageResultImage
+from ocrd_models.ocrd_page import OcrdPage
+
+from .pipeline import PipelinedProcessor
+from .skimage_binarize import SkimageBinarize
+from .skimage_denoise import SkimageDenoise
+from .skimage_denoise_raw import SkimageDenoiseRaw
+from .skimage_normalize import SkimageNormalize
+from .utils import iter_segments, map_segments, page_workers
+
+STEPS = {
+    'normalize': SkimageNormalize,
+    'denoise-raw': SkimageDenoiseRaw,
+    'binarize': SkimageBinarize,
+    'denoise': SkimageDenoise,
+}
+
+class SkimageChain(PipelinedProcessor):
+
+    @property
+    def executable(self):
+        return 'ocrd-skimage-chain'
+
+    def setup(self):
+        assert len(self.parameter['steps']) > 0, \
+            "'steps' parameter must not be empty"
+        self.steps = []
+        for name in self.parameter['steps']:
+            parameter = dict(self.parameter[name])
+            parameter['level-of-operation'] = self.parameter['level-of-operation']
+            parameter['dpi'] = self.parameter['dpi']
+            # images are saved by this processor
+            parameter['pipeline_pages'] = self.parameter['pipeline_pages']
+            if name == 'normalize':
+                # each segment must be normalized on its own here
+                parameter['page_statistics'] = False
+            elif name == 'binarize':
+                assert not parameter.get('sweep'), \
+                    "'sweep' is not supported in the 'binarize' step"
+            # validates the parameters against the respective tool
+            self.steps.append((name, STEPS[name](None, parameter=parameter)))
+
+    def _page_image_filter(self):
+        if self.parameter['steps'][0] == 'denoise':
+            return dict(feature_selector='binarized')
+        return dict(feature_filter='binarized')
+
+    def process_page_pcgts(self, *input_pcgts: Optional[OcrdPage], page_id: Optional[str] = None) -> OcrdPageResult:
+        """Performs a chain of scikit-image operations on segment or page images on the workspace.
+
+        Open and deserialize PAGE input files and their respective images,
+        then iterate over the element hierarchy down to the requested
+        ``level-of-operation`` in the element hierarchy.
+
+        For each segment element, retrieve a segment image according to
+        the layout annotation (from an existing AlternativeImage, or by
+        cropping via coordinates into the higher-level image, and -
+        when applicable - deskewing), in raw (non-binarized) form, or in
+        binarized form if the first step is ``denoise``.
+
+        Next, apply each operation of ``steps`` in turn to the image in
+        memory, just like the processors ``ocrd-skimage-normalize``,
+        ``ocrd-skimage-denoise-raw``, ``ocrd-skimage-binarize`` and
+        ``ocrd-skimage-denoise`` would with the respective parameters
+        ``normalize``, ``denoise-raw``, ``binarize`` and ``denoise``.
+        Each operation adds its feature to the cumulative ``@comments``.
+        (Operations which leave the image unchanged, like ``denoise-raw``
+        on clean images, are skipped.)
+
+        (Options of those processors which concern the page as a whole,
+        i.e. ``page_statistics``, ``page_threshold``, ``page_components``
+        and ``sweep``, are not available here.)
+
+        (If ``max_threads`` is not 1, then process the segments of a page
+        concurrently, in up to that many threads, or if zero in as many as
+        CPU cores are left by page-parallel processing. Results keep
+        document order.)
+
+        Then write the final image to the workspace along with the output
+        fileGrp, using a file ID with the suffix of the last step (like
+        ``.IMG-DEN``) with further identification of the input element.
+        (If ``intermediates`` is enabled, then also write the image of each
+        step before, with the suffix of that step - amended by the step name
+        if a later step uses the same.)
+
+        (If ``pipeline_pages`` is non-zero and pages are processed sequentially,
+        then also overlap the remaining page I/O with the chain: parse the next
+        page's input and decode its images, and encode up to that many pages of
+        result images in the background.)
+
+        Produce a new PAGE output file by serialising the resulting hierarchy.
+        """
+        pcgts = input_pcgts[0]
+        result = OcrdPageResult(pcgts)
+        page = pcgts.get_Page()
+        oplevel = self.parameter['level-of-operation']
+        image_filter = self._page_image_filter()
+
+        page_image, page_coords, page_image_info = self._image_from_page(page, page_id)
+        if self.parameter['dpi'] > 0:
+            dpi = self.parameter['dpi']
+            self.logger.info("Page '%s' images will use %d DPI from parameter override", page_id, dpi)
+        elif page_image_info.resolution != 1:
+            dpi = page_image_info.resolution
+            if page_image_info.resolutionUnit == 'cm':
+                dpi = round(dpi * 2.54)
+            self.logger.info("Page '%s' images will use %d DPI from image meta-data", page_id, dpi)
+        else:
+            dpi = 300
+            self.logger.info("Page '%s' images will use 300 DPI from fall-back", page_id)
+
+        # extra arguments of each step's _process_segment
+        steps = []
+        for name, step in self.steps:
+            if name == 'binarize':
+                args = (step._variants(dpi),)
+            elif name == 'denoise-raw':
+                args = ()
+            else:
+                args = (dpi,)
+            steps.append((name, step, args))
+
+        if oplevel == 'page':
+            result.images.extend(self._process_segment(page, page_image, page_coords, steps))
+            return result
+
+        for images in map_segments(
+                lambda segment, image, coords: self._process_segment(segment, image, coords, steps),
+                iter_segments(self.workspace, self.logger, page, page_id, page_image, page_coords,
+                              oplevel, **image_filter),
+                page_workers(self.parameter['max_threads'])):
+            result.images.extend(images)
+        return result
+
+    def _process_segment(self, segment, image, coords, steps: list) -> List[OcrdPageResultImage]:
+        results = []
+        for name, step, args in steps:
+            output = step._process_segment(segment, image, coords, *args)
+            if isinstance(output, list):
+                output, = output
+            if output is None:
+                self.logger.debug("step %s left image of %s unchanged", name, segment.id)
+                continue
+            image = output.pil
+            coords = dict(coords, features=output.alternative_image.get_comments())
+            results.append((name, output))
+        if not results:
+            return []
+        if not self.parameter['intermediates']:
+            # each step has referenced its image already
+            alternative_images = segment.get_AlternativeImage()
+            for _, output in results[:-1]:
+                alternative_images.remove(output.alternative_image)
+            return [results[-1][1]]
+        images = []
+        for i, (name, output) in enumerate(results):
+            if any(later.file_id_suffix == output.file_id_suffix for _, later in results[i + 1:]):
+                output = OcrdPageResultImage(output.pil, output.file_id_suffix + '-' + name.upper(),
+                                             output.alternative_image)
+            images.append(output)
+        return images
@@ -4,31 +4,93 @@ import os.path
 from typing import Optional
 from PIL import Image
 import numpy as np
+from scipy import ndimage as ndi
 from skimage.morphology import (
     binary_dilation, disk,
-    reconstruction,
-    remove_small_holes
+    reconstruction
 )
 
-from ocrd import Processor, OcrdPageResult, OcrdPageResultImage
+from ocrd import OcrdPageResult, OcrdPageResultImage
+from ocrd_utils import coordinates_of_segment, polygon_mask
 from ocrd_models.ocrd_page import (
     AlternativeImageType,
     PageType,
     OcrdPage,
 )
 
+from .pipeline import PipelinedProcessor
+from .utils import (
+    check_png_compression,
+    crop_page_array,
+    iter_segments,
+    map_segments,
+    page_workers,
+    png_compression,
+    process_tiled,
+)
 
-class SkimageDenoise(Processor):
+def small_components(array, maxsize):
+    """Find the background holes and foreground specks to remove from binarized ``array``.
+
+    Label the background components once and look up their areas, then
+    likewise label the foreground components after filling small holes
+    (equivalent to two passes of ``remove_small_holes``). Return masks of
+    the pixels in holes and in specks, respectively, smaller than ``maxsize``.
+    """
+    foreground = ~array.astype(bool)
+    masks = []
+    for mask in [~foreground, foreground]:
+        if masks:
+            mask = mask | masks[0]
+        # same connectivity as remove_small_holes
+        labels, _ = ndi.label(mask)
+        small = np.bincount(labels.ravel()) < maxsize
+        small[0] = False # not in mask
+        masks.append(small[labels])
+    return masks
+
+def protect_components(array1, array2, protect, method='dilation'):
+    """Find the fragments of ``array1`` within ``protect`` pixels of large components ``array2``.
+
+    Return a mask of all components of ``array1`` (8-connected) which
+    come closer than ``protect`` to ``array2``.
+
+    With ``method`` dilation, dilate ``array2`` with a disk and reconstruct
+    from there. With ``method`` distance, use a Euclidean distance transform
+    of ``array2`` instead, and labels of ``array1`` for the reconstruction.
+    (This is identical for integer ``protect``, and uses a centered disk
+    otherwise.)
+    """
+    if method == 'dilation':
+        recons = binary_dilation(array2, disk(protect))
+        recons = reconstruction(recons & array1, array1)
+        return recons.astype(bool)
+    if not array2.any():
+        return array2
+    # same radius as the (strict) disk
+    near = ndi.distance_transform_edt(~array2) <= protect
+    labels, num = ndi.label(array1, np.ones((3, 3)))
+    seeds = np.zeros(num + 1, dtype=bool)
+    seeds[labels[near & array1]] = True
+    seeds[0] = False # not in array1
+    return seeds[labels]
+
+
+class SkimageDenoise(PipelinedProcessor):
 
     @property
     def executable(self):
         return 'ocrd-skimage-denoise'
 
     def setup(self):
+        check_png_compression(self.logger, self.parameter)
         if self.parameter['protect']:
             assert self.parameter['protect'] <= self.parameter['maxsize'], \
                 "'protect' parameter must not be larger than 'maxsize'"
 
+    def _page_image_filter(self):
+        return dict(feature_selector='binarized')
+
     def process_page_pcgts(self, *input_pcgts: Optional[OcrdPage], page_id: Optional[str] = None) -> OcrdPageResult:
         """Performs binary denoising of segment or page images with scikit-image on the workspace.
 
@@ -43,11 +105,40 @@ class SkimageDenoise(Processor):
 
         Next, denoise the image by removing too small connected components
         with skimage. (If ``protect`` is non-zero, then avoid removing specks
-        near large connected components up to that distance.)
+        near large connected components up to that distance. If ``protect_method``
+        is ``distance``, then find them by distance transform instead of dilation,
+        which is much faster for large distances.)
+
+        (If ``tile_memory`` is non-zero, then process the image in horizontal
+        strips with enough context for components up to ``maxsize``, so memory
+        use stays within that many MB. Results are identical, except that
+        ``protect`` cannot reconstruct large components beyond the context.)
+
+        (If ``page_components`` is enabled and operating below the page level,
+        then label connected components only once on the page image, and crop
+        the resulting masks of small components for each segment. This differs
+        only where segments cut through components, which keep their size on
+        the page. Segments which are not plain crops of the page image, e.g.
+        because they got deskewed or have an AlternativeImage of their own,
+        are labelled separately, and so are segments which differ from the
+        page within their polygon, because some ancestor masked them. Outside
+        the polygon of each segment, which was filled with background, nothing
+        gets removed.)
+
+        (If ``max_threads`` is not 1, then despeckle the segments of a page
+        concurrently, in up to that many threads, or if zero in as many as
+        CPU cores are left by page-parallel processing. Results keep
+        document order.)
 
         Then write the new image to the workspace along with the output fileGrp,
         and using a file ID with suffix ``.IMG-DEN`` with further identification
-        of the input element.
+        of the input element. (If ``output_1bit`` is enabled, then save as
+        1-bit PNG even if the input image was 8-bit. If ``compress_level`` is
+        not -1, then compress with that zlib level instead of the default.)
+
+        (If ``pipeline_pages`` is non-zero, then overlap page I/O with despeckling
+        when processing pages sequentially: parse and decode the next page's input ahead,
+        and let the result images of up to that many pages be encoded behind.)
 
         Produce a new PAGE output file by serialising the resulting hierarchy.
         """
@@ -56,8 +147,7 @@ class SkimageDenoise(Processor):
         page = pcgts.get_Page()
         oplevel = self.parameter['level-of-operation']
 
-        page_image, page_coords, page_image_info = self.workspace.image_from_page(
-            page, page_id, feature_selector='binarized')
+        page_image, page_coords, page_image_info = self._image_from_page(page, page_id)
         if self.parameter['dpi'] > 0:
             dpi = self.parameter['dpi']
             self.logger.info("Page '%s' images will use %d DPI from parameter override", page_id, dpi)
@@ -76,54 +166,24 @@ class SkimageDenoise(Processor):
                 result.images.append(image)
             return result
 
-        regions = page.get_AllRegions(classes=['Text'])
-        if not regions:
-            self.logger.warning("Page '%s' contains no text regions", page_id)
-        for region in regions:
-            region_image, region_coords = self.workspace.image_from_segment(
-                region, page_image, page_coords, feature_selector='binarized')
-            if oplevel == 'region':
-                image = self._process_segment(region, region_image, region_coords, dpi)
-                if image:
-                    result.images.append(image)
-                continue
-
-            lines = region.get_TextLine()
-            if not lines:
-                self.logger.warning("Region '%s' contains no text lines", region.id)
-            for line in lines:
-                line_image, line_coords = self.workspace.image_from_segment(
-                    line, region_image, region_coords, feature_selector='binarized')
-                if oplevel == 'line':
-                    image = self._process_segment(line, line_image, line_coords, dpi)
-                    if image:
-                        result.images.append(image)
-                    continue
-
-                words = line.get_Word()
-                if not words:
-                    self.logger.warning("Line '%s' contains no words", line.id)
-                for word in words:
-                    word_image, word_coords = self.workspace.image_from_segment(
-                        word, line_image, line_coords, feature_selector='binarized')
-                    if oplevel == 'word':
-                        image = self._process_segment(word, word_image, word_coords, dpi)
-                        if image:
-                            result.images.append(image)
-                        continue
-
-                    glyphs = word.get_Glyph()
-                    if not glyphs:
-                        self.logger.warning("Word '%s' contains no glyphs", word.id)
-                    for glyph in glyphs:
-                        glyph_image, glyph_coords = self.workspace.image_from_segment(
-                            glyph, word_image, word_coords, feature_selector='binarized')
-                        image = self._process_segment(glyph, glyph_image, glyph_coords, dpi)
-                        if image:
-                            result.images.append(image)
+        page_array = page_masks = None
+        if self.parameter['page_components']:
+            maxsize = (self.parameter['maxsize'] * dpi / 72) ** 2
+            page_array = np.array(page_image)
+            page_masks = small_components(page_array, maxsize)
+
+        for image in map_segments(
+                lambda segment, segment_image, segment_coords: self._process_segment(
+                    segment, segment_image, segment_coords, dpi, page_masks, page_coords, page_array),
+                iter_segments(self.workspace, self.logger, page, page_id, page_image, page_coords,
+                              oplevel, feature_selector='binarized'),
+                page_workers(self.parameter['max_threads'])):
+            if image:
+                result.images.append(image)
         return result
 
-    def _process_segment(self, segment, image, coords, dpi) -> Optional[OcrdPageResultImage]:
+    def _process_segment(self, segment, image, coords, dpi,
+                         page_masks=None, page_coords=None, page_array=None) -> Optional[OcrdPageResultImage]:
         features = coords['features'] # features already applied to image
         features += ',despeckled'
         maxsize = self.parameter['maxsize']
@@ -134,18 +194,53 @@ class SkimageDenoise(Processor):
         array = np.array(image)
         dtype = array.dtype
         scale = array.max()
-        array = ~array.astype(bool)
-        # suppress bg specks in fg (holes in binary-inverted)
-        array1 = remove_small_holes(array, area_threshold=maxsize)
-        # suppress fg specks in bg (blobs in binary-inverted)
-        array2 = ~remove_small_holes(~array1, area_threshold=maxsize)
-        if protect:
-            # reconstruct fragments of larger objects
-            recons = binary_dilation(array2, disk(protect))
-            recons = reconstruction(recons & array1, array1)
-            array2 |= recons.astype(bool)
-        array = ~array2
-        image = Image.fromarray(array.astype(dtype) * scale)
+        masks = None
+        if page_masks is not None:
+            masks = [crop_page_array(mask, page_coords, coords, array.shape)
+                     for mask in page_masks]
+            if masks[0] is None:
+                self.logger.debug("Segment '%s' is no plain crop of the page, labelling separately",
+                                  segment.id)
+                masks = None
+            else:
+                # outside its polygon, the segment image was filled with background,
+                # so nothing (like holes of other segments' glyphs) must be removed there
+                inside = np.array(polygon_mask(image, coordinates_of_segment(
+                    segment, image, coords))).astype(bool)
+                if not np.array_equal(array[inside], crop_page_array(
+                        page_array, page_coords, coords, array.shape)[inside]):
+                    # masked by some ancestor's polygon
+                    self.logger.debug("Segment '%s' differs from the page within its polygon, "
+                                      "labelling separately", segment.id)
+                    masks = None
+                else:
+                    masks = [mask & inside for mask in masks]
+        def despeckle(array, masks=None):
+            if masks is None:
+                masks = small_components(array, maxsize)
+            holes, specks = masks
+            # suppress bg specks in fg (holes in binary-inverted)
+            array1 = ~array.astype(bool) | holes
+            # suppress fg specks in bg (blobs in binary-inverted)
+            array2 = array1 & ~specks
+            if protect:
+                # reconstruct fragments of larger objects
+                array2 |= protect_components(array1, array2, protect,
+                                             self.parameter['protect_method'])
+            return ~array2
+        if masks is not None:
+            array = despeckle(array, masks)
+        else:
+            # components smaller than maxsize cannot reach further (in either pass)
+            halo = 2 * int(np.ceil(maxsize)) + int(np.ceil(protect)) + 2
+            # labels, float reconstruction and several masks
+            array = process_tiled(despeckle, array, self.parameter['tile_memory'],
+                                  pixel_bytes=40, halo=halo)
+        if self.parameter['output_1bit']:
+            image = Image.fromarray(array)
+        else:
+            image = Image.fromarray(array.astype(dtype) * scale)
+        png_compression(image, self.parameter['compress_level'])
         # update PAGE (reference the image file):
         image_ref = AlternativeImageType(comments=features)
         segment.add_AlternativeImage(image_ref)
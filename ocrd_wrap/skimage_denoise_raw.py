@@ -1,21 +1,168 @@
 from __future__ import absolute_import
 
+import logging
 import os.path
 from typing import Optional
 from packaging.version import Version
 from PIL import Image
-from skimage import img_as_uint, img_as_ubyte, __version__ as skimage_version
+import numpy as np
+import pywt
+from scipy.stats import norm
+from skimage import img_as_float, img_as_uint, img_as_ubyte, __version__ as skimage_version
+from skimage.color import rgb2ycbcr, ycbcr2rgb
 from skimage.restoration import denoise_wavelet, estimate_sigma
 
-from ocrd import Processor, OcrdPageResult, OcrdPageResultImage
+from ocrd import OcrdPageResult, OcrdPageResultImage
 from ocrd_models.ocrd_page import (
     AlternativeImageType,
     PageType,
     OcrdPage,
 )
 
+from .pipeline import PipelinedProcessor
+from .utils import (
+    iter_segments,
+    iter_strips,
+    map_segments,
+    page_workers,
+    segment_offset,
+    strip_rows,
+)
+
+# default of denoise_wavelet
+WAVELET = 'db1'
+# tile size for sampling the noise level
+SAMPLE_TILE = 64
+
+def strip_wavedecn(channel, levels):
+    """Decompose a strip of an image like ``pywt.wavedecn``, with ``levels`` of the whole image.
+
+    (Those are deliberately higher than the strip itself would get, so
+    apply ``pywt.dwtn`` level by level, which does not warn about them.)
+    """
+    coeffs = []
+    for _ in range(levels):
+        level = pywt.dwtn(channel, WAVELET)
+        channel = level.pop('a' * channel.ndim)
+        coeffs.insert(0, level)
+    return [channel] + coeffs
+
+def wavelet_channels(array, rgb: bool):
+    """Float channels of ``array`` (in YCbCr if ``rgb``), as denoised by ``denoise_wavelet``."""
+    array = img_as_float(array)
+    if rgb:
+        return np.moveaxis(rgb2ycbcr(array), -1, 0)
+    return array[np.newaxis]
+
+def raw_array(image):
+    """Convert ``image`` to a uint16 array (without alpha), and tell whether it is RGB."""
+    if image.mode == 'RGBA':
+        image = image.convert('RGB')
+    elif image.mode == 'LA':
+        image = image.convert('L')
+    return img_as_uint(image), image.mode == 'RGB'
+
+def noise_details(channel, rows=0):
+    """Finest diagonal wavelet coefficients (db2) of ``channel``, like ``pywt.dwtn``.
+
+    If ``rows`` is non-zero, then transform in strips of that many rows
+    (rounded up to even), with enough context for identical coefficients.
+    """
+    height = channel.shape[0]
+    if not rows or rows >= height:
+        return pywt.dwtn(channel, 'db2')['dd']
+    rows += rows % 2
+    strips = []
+    for start in range(0, height, rows):
+        stop = min(height, start + rows)
+        # coefficient k depends on rows 2k-2 to 2k+1
+        first = max(0, start - 4)
+        details = pywt.dwtn(channel[first:min(height, stop + 4)], 'db2')['dd']
+        begin = (start - first) // 2
+        # the last strip also gets the coefficients of the padding
+        end = begin + (stop - start) // 2 if stop < height else None
+        strips.append(details[begin:end])
+    return np.concatenate(strips)
+
+def details_sigma(details):
+    """Estimate the noise standard deviation from the finest diagonal wavelet coefficients."""
+    # consider coefficients exactly zero to be masked out
+    details = details[np.nonzero(details)]
+    return np.median(np.abs(details)) / norm.ppf(0.75)
+
+def sample_sigma(array, rgb: bool, fraction=1.0, rows=0):
+    """Estimate the noise standard deviation of ``array`` like ``estimate_sigma``.
+
+    Use the median of the finest diagonal wavelet coefficients (db2) of each
+    channel, averaged over channels if ``rgb``. If ``fraction`` is less than 1,
+    then only transform that fraction of the image's tiles, sampled evenly.
+    (Coefficients along the tile borders are dropped.) If ``rows`` is non-zero,
+    then transform in strips of about that many rows, with identical results.
+    """
+    channels = np.moveaxis(array, -1, 0) if rgb else array[np.newaxis]
+    tile_rows, cols = array.shape[0] // SAMPLE_TILE, array.shape[1] // SAMPLE_TILE
+    # tile rows per strip
+    band = max(1, rows // SAMPLE_TILE) if rows else tile_rows
+    sigmas = []
+    for channel in channels:
+        if fraction >= 1 or tile_rows * cols * fraction < 4:
+            details = noise_details(channel, rows)
+        else:
+            # every 1/fraction-th tile in raster order (staggered across rows)
+            chosen = np.arange(int(np.ceil(tile_rows * cols * fraction))) / fraction
+            chosen = np.unique(chosen.astype(int))
+            details = []
+            for first in range(0, tile_rows, band):
+                last = min(tile_rows, first + band)
+                indices = chosen[(chosen >= first * cols) & (chosen < last * cols)] - first * cols
+                if not indices.size:
+                    continue
+                tiles = channel[first * SAMPLE_TILE:last * SAMPLE_TILE, :cols * SAMPLE_TILE]
+                tiles = tiles.reshape(last - first, SAMPLE_TILE, cols, SAMPLE_TILE).swapaxes(1, 2)
+                tiles = tiles.reshape((last - first) * cols, SAMPLE_TILE, SAMPLE_TILE)
+                details.append(pywt.dwtn(tiles[indices], 'db2', axes=(1, 2))['dd'][:, 1:-1, 1:-1])
+            details = np.concatenate(details)
+        sigmas.append(details_sigma(details))
+    if rgb:
+        return np.mean(sigmas)
+    return sigmas[0]
+
+class PageNoise:
+    """Estimate the noise level of a page image once, and of its segments from there.
+
+    Keep the finest diagonal wavelet coefficients (db2) of each channel of the
+    page image (cf. :py:func:`noise_details`), so the noise level of each segment
+    which is a plain crop of the page image can be estimated from the coefficients
+    depending on its bounding box only, without transforming the segment image.
+    """
+
+    def __init__(self, array, rgb: bool, coords, rows=0):
+        channels = np.moveaxis(array, -1, 0) if rgb else array[np.newaxis]
+        self.details = [noise_details(channel, rows) for channel in channels]
+        self.shape = array.shape[:2]
+        self.coords = coords
 
-class SkimageDenoiseRaw(Processor):
+    def sigma(self, coords=None, shape=None):
+        """Estimate the noise level of the page, or of the segment image with ``coords`` and ``shape``.
+
+        Return None if the segment image is no plain crop of the page image.
+        """
+        details = self.details
+        if coords is not None:
+            offset = segment_offset(self.coords, coords, shape, self.shape)
+            if offset is None:
+                return None
+            left, top = offset
+            height, width = shape[:2]
+            details = [channel[(top + 3) // 2:(top + height) // 2,
+                               (left + 3) // 2:(left + width) // 2]
+                       for channel in details]
+            if not details[0].size:
+                # too small
+                return None
+        return np.mean([details_sigma(channel) for channel in details])
+
+class SkimageDenoiseRaw(PipelinedProcessor):
 
     @property
     def executable(self):
@@ -48,10 +195,32 @@ class SkimageDenoiseRaw(Processor):
         Next, denoise the image with a Wavelet transform scheme according
         to ``method`` in skimage.
 
+        (Skip images which are already clean, i.e. with a noise level below
+        1e-5. The noise level is estimated on a ``sample_fraction`` of the
+        image. When operating below the page level on the full images, estimate
+        it for the page image first, and skip all segments if the page is clean.
+        Otherwise, estimate it for each segment from the page's wavelet
+        coefficients within its bounding box, unless the segment is no plain
+        crop of the page image.)
+
+        (If ``tile_memory`` is non-zero, then process the image in horizontal
+        strips aligned to the coarsest wavelet level, so memory use stays
+        within that many MB. Noise level and thresholds are determined for
+        the whole image in a first pass, so results are identical.)
+
+        (If ``max_threads`` is not 1, then denoise the segments of a page
+        concurrently, in up to that many threads, or if zero in as many as
+        CPU cores are left by page-parallel processing. Results keep
+        document order.)
+
         Then write the new image to the workspace along with the output fileGrp,
         and using a file ID with suffix ``.IMG-DEN`` with further identification
         of the input element.
 
+        (If ``pipeline_pages`` is non-zero and pages are not processed in parallel,
+        then parse and decode the next page's input while denoising the current one,
+        and encode up to that many pages of result images in the background.)
+
         Produce a new PAGE output file by serialising the resulting hierarchy.
         """
         pcgts = input_pcgts[0]
@@ -59,8 +228,7 @@ class SkimageDenoiseRaw(Processor):
         page = pcgts.get_Page()
         oplevel = self.parameter['level-of-operation']
 
-        page_image, page_coords, page_image_info = self.workspace.image_from_page(
-            page, page_id, feature_filter='binarized')
+        page_image, page_coords, page_image_info = self._image_from_page(page, page_id)
         if self.parameter['dpi'] > 0:
             dpi = self.parameter['dpi']
             self.logger.info("Page '%s' images will use %d DPI from parameter override", page_id, dpi)
@@ -79,89 +247,158 @@ class SkimageDenoiseRaw(Processor):
                 result.images.append(image)
             return result
 
-        regions = page.get_AllRegions(classes=['Text'])
-        if not regions:
-            self.logger.warning("Page '%s' contains no text regions", page_id)
-        for region in regions:
-            region_image, region_coords = self.workspace.image_from_segment(
-                region, page_image, page_coords, feature_filter='binarized')
-            if oplevel == 'region':
-                image = self._process_segment(region, region_image, region_coords)
-                if image:
-                    result.images.append(image)
-                continue
+        page_noise = None
+        if self.parameter['sample_fraction'] >= 1:
+            # (a sample of the page would not cover the segments)
+            array, rgb = raw_array(page_image)
+            rows = strip_rows(array.shape, self.parameter['tile_memory'], 48, align=2)
+            page_noise = PageNoise(array, rgb, page_coords, rows)
+            page_sigma = page_noise.sigma()
+            self.logger.debug("estimated sigma of page: %s", page_sigma)
+            if page_sigma < 1e-5:
+                self.logger.info("Page '%s' is already clean, skipping all segments", page_id)
+                return result
 
-            lines = region.get_TextLine()
-            if not lines:
-                self.logger.warning("Region '%s' contains no text lines", region.id)
-            for line in lines:
-                line_image, line_coords = self.workspace.image_from_segment(
-                    line, region_image, region_coords, feature_filter='binarized')
-                if oplevel == 'line':
-                    image = self._process_segment(line, line_image, line_coords)
-                    if image:
-                        result.images.append(image)
-                    continue
-
-                words = line.get_Word()
-                if not words:
-                    self.logger.warning("Line '%s' contains no words", line.id)
-                for word in words:
-                    word_image, word_coords = self.workspace.image_from_segment(
-                        word, line_image, line_coords, feature_filter='binarized')
-                    if oplevel == 'word':
-                        image = self._process_segment(word, word_image, word_coords)
-                        if image:
-                            result.images.append(image)
-                        continue
-
-                    glyphs = word.get_Glyph()
-                    if not glyphs:
-                        self.logger.warning("Word '%s' contains no glyphs", word.id)
-                    for glyph in glyphs:
-                        glyph_image, glyph_coords = self.workspace.image_from_segment(
-                            glyph, word_image, word_coords, feature_filter='binarized')
-                        image = self._process_segment(glyph, glyph_image, glyph_coords)
-                        if image:
-                            result.images.append(image)
+        for image in map_segments(
+                lambda segment, segment_image, segment_coords: self._process_segment(
+                    segment, segment_image, segment_coords, page_noise),
+                iter_segments(self.workspace, self.logger, page, page_id, page_image, page_coords,
+                              oplevel, feature_filter='binarized'),
+                page_workers(self.parameter['max_threads'])):
+            if image:
+                result.images.append(image)
         return result
 
-    def _process_segment(self, segment, image, coords) -> Optional[OcrdPageResultImage]:
+    def _process_segment(self, segment, image, coords, page_noise=None) -> Optional[OcrdPageResultImage]:
         features = coords['features'] # features already applied to image
         features += ',despeckled'
         method = self.parameter['method']
         self.logger.debug("processing %s image size %s mode %s with method %s",
                           coords['features'], str(image.size), str(image.mode), method)
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        elif image.mode == 'LA':
-            image = image.convert('L')
-        kwargs = self.skimage_kwargs(image.mode == 'RGB')
-        kwargs2 = dict(kwargs)
-        kwargs2["convert2ycbcr"] = kwargs2.pop("average_sigmas")
-        array = img_as_uint(image)
-        # Estimate the average noise standard deviation across color channels.
-        sigma_est = estimate_sigma(array, **kwargs)
+        array, rgb = raw_array(image)
+        if image.mode in ['F', 'I']:
+            convert = img_as_uint
+        else:
+            convert = img_as_ubyte
+        # wavelet levels like denoise_wavelet
+        levels = max(pywt.dwtn_max_level(array.shape[:2], WAVELET) - 3, 1)
+        # float64 image, coefficients, YCbCr copies and output
+        rows = strip_rows(array.shape, self.parameter['tile_memory'], 48, align=2 ** levels)
+        tiled = rows < array.shape[0]
+        sigma_est = None
+        if page_noise is not None:
+            sigma_est = page_noise.sigma(coords, array.shape)
+        if sigma_est is None:
+            sigma_est = self._estimate_sigma(array, rgb, rows if tiled else 0)
         self.logger.debug("estimated sigma before: %s", sigma_est)
         if sigma_est < 1e-5:
             # avoid adverse effects of denoising already clean images
             return None
-        array = denoise_wavelet(array,
-                                # BayesShrink does not seem to do much, but ignores sigma;
-                                # VisuShrink works but tends to underestimate sigma
-                                #sigma=None if method == 'BayesShrink' else sigma_est/4,
-                                method=method, mode='soft', rescale_sigma=True,
-                                **kwargs2
-        )
-        sigma_est = estimate_sigma(array, **kwargs)
-        self.logger.debug("estimated sigma after: %s", sigma_est)
-        if image.mode in ['F', 'I']:
-            array = img_as_uint(array)
+        if tiled:
+            array = self._denoise_tiled(array, rgb, method, levels, rows, convert)
         else:
-            array = img_as_ubyte(array)
+            array = self._denoise(array, rgb, method, convert)
         image = Image.fromarray(array)
         # update PAGE (reference the image file):
         image_ref = AlternativeImageType(comments=features)
         segment.add_AlternativeImage(image_ref)
         suffix = "" if isinstance(segment, PageType) else segment.id
         return OcrdPageResultImage(image, suffix + '.IMG-DEN', image_ref)
+
+    def _estimate_sigma(self, array, rgb, rows=0):
+        """Estimate the average noise standard deviation across color channels.
+
+        (If ``rows`` is non-zero, then transform in strips of that many rows.)
+        """
+        fraction = self.parameter['sample_fraction']
+        if fraction >= 1 and not rows:
+            return estimate_sigma(array, **self.skimage_kwargs(rgb))
+        return sample_sigma(array, rgb, fraction, rows)
+
+    def _denoise(self, array, rgb, method, convert):
+        kwargs = self.skimage_kwargs(rgb)
+        kwargs2 = dict(kwargs)
+        kwargs2["convert2ycbcr"] = kwargs2.pop("average_sigmas")
+        array = denoise_wavelet(array,
+                                # BayesShrink does not seem to do much, but ignores sigma;
+                                # VisuShrink works but tends to underestimate sigma
+                                #sigma=None if method == 'BayesShrink' else sigma_est/4,
+                                method=method, mode='soft', rescale_sigma=True,
+                                **kwargs2
+        )
+        if self.logger.isEnabledFor(logging.DEBUG):
+            sigma_est = estimate_sigma(array, **kwargs)
+            self.logger.debug("estimated sigma after: %s", sigma_est)
+        return convert(array)
+
+    def _denoise_tiled(self, array, rgb, method, levels, rows, convert):
+        """Denoise like ``denoise_wavelet``, but in strips of ``rows``, with thresholds for the whole image.
+
+        Haar wavelets of different dyadic blocks do not overlap, so strips
+        aligned to the coarsest level yield the same coefficients without
+        any context.
+        """
+        height, width = array.shape[:2]
+        nchannels = 3 if rgb else 1
+        # first pass: range, noise and subband energy of each channel
+        minima = np.full(nchannels, np.inf)
+        maxima = np.full(nchannels, -np.inf)
+        details = [[] for _ in range(nchannels)]
+        energies = [[{} for _ in range(levels)] for _ in range(nchannels)]
+        for _, start, stop, _ in iter_strips(height, rows):
+            for i, channel in enumerate(wavelet_channels(array[start:stop], rgb)):
+                minima[i] = min(minima[i], channel.min())
+                maxima[i] = max(maxima[i], channel.max())
+                dcoeffs = strip_wavedecn(channel, levels)[1:]
+                finest = dcoeffs[-1]['dd']
+                details[i].append(np.abs(finest[np.nonzero(finest)]))
+                for level, energy in zip(dcoeffs, energies[i]):
+                    for key, coeffs in level.items():
+                        total, count = energy.get(key, (0.0, 0))
+                        energy[key] = total + np.sum(coeffs * coeffs), count + coeffs.size
+        # YCbCr channels get normalized to [0, 1]
+        scales = maxima - minima if rgb else np.ones(1)
+        sigmas = [np.median(np.concatenate(detail)) / norm.ppf(0.75) if sum(map(len, detail)) else 0.0
+                  for detail in details]
+        thresholds = []
+        for sigma, scale, energy in zip(sigmas, scales, energies):
+            if not scale:
+                thresholds.append(None)
+                continue
+            sigma /= scale
+            if method == 'VisuShrink':
+                thresholds.append([{key: sigma * np.sqrt(2 * np.log(height * width))
+                                    for key in level} for level in energy])
+            else:
+                var = sigma ** 2
+                eps = np.finfo(np.float64).eps
+                thresholds.append([{key: var / np.sqrt(max(total / count / scale ** 2 - var, eps))
+                                    for key, (total, count) in level.items()}
+                                   for level in energy])
+        # second pass: threshold and reconstruct
+        result = None
+        for _, start, stop, _ in iter_strips(height, rows):
+            channels = wavelet_channels(array[start:stop], rgb)
+            for i, channel in enumerate(channels):
+                if thresholds[i] is None:
+                    continue
+                if rgb:
+                    channel -= minima[i]
+                    channel /= scales[i]
+                coeffs = strip_wavedecn(channel, levels)
+                coeffs[1:] = [{key: pywt.threshold(level[key], value=threshold[key], mode='soft')
+                               for key in level}
+                              for threshold, level in zip(thresholds[i], coeffs[1:])]
+                channel[:] = pywt.waverecn(coeffs, WAVELET)[:channel.shape[0], :channel.shape[1]]
+                if rgb:
+                    channel *= scales[i]
+                    channel += minima[i]
+            if rgb:
+                strip = ycbcr2rgb(np.moveaxis(channels, 0, -1))
+            else:
+                strip = channels[0]
+            strip = convert(np.clip(strip, 0, 1))
+            if result is None:
+                result = np.empty(array.shape, dtype=strip.dtype)
+            result[start:stop] = strip
+        return result
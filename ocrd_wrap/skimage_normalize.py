@@ -1,22 +1,196 @@
 from __future__ import absolute_import
 
+import logging
 import os.path
 from typing import Optional
 from PIL import Image
 import numpy as np
 from skimage import img_as_float, img_as_uint, img_as_ubyte
+from skimage.color import rgb2hsv, hsv2rgb
 from skimage.color.adapt_rgb import adapt_rgb, hsv_value
 from skimage.exposure import rescale_intensity, equalize_adapthist
+try:
+    # CLAHE core without the normalization of the whole image (for tiling)
+    from skimage.exposure._adapthist import _clahe, NR_OF_GRAY
+except ImportError:
+    # private API changed: adapthist cannot be tiled
+    _clahe = None
 
-from ocrd import Processor, OcrdPageResult, OcrdPageResultImage
+from ocrd import OcrdPageResult, OcrdPageResultImage
 from ocrd_models.ocrd_page import (
     AlternativeImageType,
     PageType,
     OcrdPage,
 )
 
+from .pipeline import PipelinedProcessor
+from .utils import (
+    iter_segments,
+    iter_strips,
+    map_segments,
+    page_workers,
+    process_tiled,
+    selects_alternative_image,
+    strip_rows,
+)
+
+
+def histogram_percentiles(hist, q, values):
+    """Compute percentiles ``q`` of integer samples given their histogram ``hist``.
+
+    Each bin of ``hist`` stands for the (float) value at the same index in
+    ``values``. Interpolate linearly like ``np.percentile`` does.
+    """
+    count = hist.sum()
+    cumsum = np.cumsum(hist)
+    quantiles = np.true_divide(q, 100)
+    index = count * quantiles + (1 - quantiles) - 1
+    lower = np.floor(index)
+    gamma = index - lower
+    lower = np.clip(lower, 0, count - 1).astype(np.intp)
+    upper = np.clip(lower + 1, 0, count - 1)
+    lower = values[np.searchsorted(cumsum, lower, side='right')]
+    upper = values[np.searchsorted(cumsum, upper, side='right')]
+    diff = upper - lower
+    return np.where(gamma >= 0.5, upper - diff * (1 - gamma), lower + diff * gamma)
 
-class SkimageNormalize(Processor):
+def value_channel(array, rgb: bool):
+    """Float image of ``array``, or its HSV value channel if ``rgb``."""
+    if rgb:
+        return rgb2hsv(img_as_float(array))[:, :, 2]
+    return img_as_float(array)
+
+def stretch_integer(array, rgb: bool, black_point, white_point, convert, memory=0, hsv=False):
+    """Stretch 8 or 16 bit ``array`` between percentiles like ``rescale_intensity``, but without float copies.
+
+    Percentiles are interpolated from a histogram of the integer values.
+    Grayscale images are mapped through a lookup table of all values.
+    RGB images are stretched on their value (i.e. channel maximum) by scaling
+    all channels with the ratio of stretched and original value, which is
+    what a round trip through HSV amounts to (up to rounding). If ``hsv``,
+    then do that round trip instead. RGB images are processed in strips
+    within ``memory`` MB.
+    """
+    height = array.shape[0]
+    rows = strip_rows(array.shape, memory, 48 if hsv else 8)
+    # percentiles of (value channel) samples in the whole image
+    hist = np.zeros(np.iinfo(array.dtype).max + 1, dtype=np.int64)
+    for _, start, stop, _ in iter_strips(height, rows):
+        strip = array[start:stop]
+        if rgb:
+            strip = strip.max(axis=2)
+        hist += np.bincount(strip.ravel(), minlength=hist.size)
+    values = img_as_float(np.arange(hist.size, dtype=array.dtype))
+    v_min, v_max = histogram_percentiles(hist, (black_point, 100 - white_point), values)
+    # rescaling and conversion are pointwise
+    stretched = rescale_intensity(values, in_range=(v_min, v_max))
+    if not rgb:
+        return convert(stretched)[array]
+    if hsv:
+        @adapt_rgb(hsv_value)
+        def normalize(a):
+            return rescale_intensity(a, in_range=(v_min, v_max))
+        return process_tiled(lambda strip: convert(normalize(img_as_float(strip))),
+                             array, memory, pixel_bytes=48)
+    ratio = np.zeros_like(values)
+    np.divide(stretched, values, out=ratio, where=values > 0)
+    def scale(strip):
+        factor = ratio[strip.max(axis=2)]
+        # (RGB images are 8 bit, like the output)
+        result = np.empty_like(strip)
+        for channel in range(strip.shape[2]):
+            result[:, :, channel] = np.rint(strip[:, :, channel] * factor)
+        return result
+    return process_tiled(scale, array, memory, pixel_bytes=8)
+
+def equalize_fast(array, rgb: bool, kernel_size, clip_limit, convert, decimation=1, hsv=False):
+    """Contrast limited adaptive histogram equalization of 8 or 16 bit ``array``, like ``equalize_adapthist``.
+
+    Count the histograms (of 256 bins across the value range) of all
+    contextual regions of ``kernel_size`` at once, on every ``decimation``-th
+    pixel in either direction only. Clip and map them vectorized across
+    regions. Interpolate the mappings bilinearly between region centers,
+    blending horizontally only once for each row of regions.
+
+    RGB images are equalized on their value (i.e. channel maximum), scaling
+    all channels by the ratio of equalized and original value, or (if ``hsv``)
+    converting to HSV and back.
+    """
+    height, width = array.shape[:2]
+    value = array.max(axis=2) if rgb else array
+    nbins = 256
+    v_min, v_max = int(value.min()), int(value.max())
+    bins = np.arange(np.iinfo(array.dtype).max + 1) - v_min
+    bins = np.clip(bins * nbins // (v_max - v_min + 1), 0, nbins - 1).astype(np.uint8)
+    bins = bins[value]
+    kernel_height, kernel_width = kernel_size
+    nrows, ncols = -(-height // kernel_height), -(-width // kernel_width)
+    # histograms of all regions from one count
+    regions = (np.arange(0, height, decimation)[:, np.newaxis] // kernel_height * ncols +
+               np.arange(0, width, decimation)[np.newaxis, :] // kernel_width)
+    regions = regions * nbins + bins[::decimation, ::decimation]
+    hist = np.bincount(regions.ravel(), minlength=nrows * ncols * nbins)
+    hist = hist.reshape(nrows * ncols, nbins).astype(np.float64)
+    counts = np.maximum(hist.sum(axis=1, keepdims=True), 1)
+    if clip_limit > 0:
+        limit = np.maximum(clip_limit * counts, 1)
+        # redistribute excess evenly, until (almost) nothing is clipped anymore
+        for _ in range(10):
+            excess = np.clip(hist - limit, 0, None).sum(axis=1, keepdims=True)
+            if excess.max() < 1:
+                break
+            np.minimum(hist, limit, out=hist)
+            hist += excess / nbins
+    maps = np.cumsum(hist, axis=1) / counts
+    maps = maps.astype(np.float32).reshape(nrows, ncols, nbins)
+    def position(size, kernel, count):
+        # between which region centers (and how far) each pixel lies
+        pos = np.clip((np.arange(size) - (kernel - 1) / 2) / kernel, 0, count - 1)
+        lower = np.floor(pos).astype(int)
+        upper = np.minimum(lower + 1, count - 1)
+        return lower, upper, (pos - lower).astype(np.float32)
+    left, right, xweight = position(width, kernel_width, ncols)
+    top, bottom, yweight = position(height, kernel_height, nrows)
+    def blend(row):
+        # mappings for each column (flattened columns by bins)
+        return (maps[row, left] * (1 - xweight[:, np.newaxis]) +
+                maps[row, right] * xweight[:, np.newaxis]).ravel()
+    result = np.empty((height, width), dtype=np.float32)
+    offsets = np.arange(width) * nbins
+    upper_map = blend(0)
+    for row in range(nrows):
+        lower_map = upper_map
+        upper_map = blend(min(row + 1, nrows - 1))
+        rows = np.flatnonzero(top == row)
+        if not rows.size:
+            continue
+        start, stop = rows[0], rows[-1] + 1
+        index = offsets + bins[start:stop]
+        weight = yweight[start:stop, np.newaxis]
+        result[start:stop] = lower_map[index] * (1 - weight) + upper_map[index] * weight
+    # stretch to full range (like equalize_adapthist)
+    result -= result.min()
+    if result.max() > 0:
+        result /= result.max()
+    if not rgb:
+        return convert(result)
+    if hsv:
+        image = rgb2hsv(img_as_float(array))
+        image[:, :, 2] = result
+        return convert(hsv2rgb(image))
+    # (RGB images are 8 bit, like the output)
+    scale = np.iinfo(array.dtype).max
+    factor = np.zeros_like(result)
+    np.divide(result * scale, value, out=factor, where=value > 0)
+    output = np.empty_like(array)
+    for channel in range(array.shape[2]):
+        output[:, :, channel] = np.rint(array[:, :, channel] * factor)
+    # black becomes gray (without hue) like in HSV
+    black = value == 0
+    output[black] = np.rint(result[black] * scale)[:, np.newaxis]
+    return output
+
+class SkimageNormalize(PipelinedProcessor):
 
     @property
     def executable(self):
@@ -36,18 +210,56 @@ class SkimageNormalize(Processor):
 
         Next, normalize the image according to ``method`` in skimage.
 
+        (For ``stretch`` on 8 or 16 bit images, determine the percentiles from
+        a histogram of the integer values, and map grayscale images through a
+        lookup table of all values instead of converting to float. Results
+        are identical. RGB images are stretched on their HSV value, by scaling
+        all channels with the ratio of stretched and original value, which
+        differs by rounding only. If ``hsv`` is enabled, then convert to HSV
+        and back instead, like previous versions.)
+
+        (For ``adapthist``, use contextual regions of ``kernel_size`` pixels,
+        or 1/8 of the image's width and height if zero, or about 1 inch if
+        negative. If ``adapthist_engine`` is ``fast``, then count histograms
+        of all regions at once, on every ``decimation``-th pixel only, clip
+        and map them in a vectorized way, and interpolate between regions
+        with less passes. RGB images are then equalized on their value like
+        with ``stretch``. Results differ slightly from ``skimage``.)
+
+        (If ``page_statistics`` is enabled and ``level-of-operation`` is below
+        the page, then normalize the page image only once, and crop each segment
+        from the result, so all segments share the same black and white point
+        or contextual mappings. Segments with their own AlternativeImage are
+        still normalized separately.)
+
+        (If ``tile_memory`` is non-zero, then process 8 or 16 bit images in
+        horizontal strips, so memory use stays within that many MB. Global
+        parts like percentiles or the value range are determined for the whole
+        image. For ``adapthist``, strips are aligned to its tiles, and include
+        two rows of tiles as context. So results are identical. Where this
+        version of scikit-image lacks the internals needed for tiling, it is
+        not tiled.)
+
+        (If ``max_threads`` is not 1, then normalize the segments of a page
+        concurrently, in up to that many threads, or if zero in as many as
+        CPU cores are left by page-parallel processing. Results keep
+        document order.)
+
         Then write the new image to the workspace along with the output fileGrp,
         and using a file ID with suffix ``.IMG-NRM`` with further identification
         of the input element.
 
+        (If ``pipeline_pages`` is non-zero and pages are processed sequentially,
+        then parse and decode the next page's input in the background, and encode
+        the result images of up to that many pages in the background, too.)
+
         Produce a new PAGE output file by serialising the resulting hierarchy.
         """
         pcgts = input_pcgts[0]
         result = OcrdPageResult(pcgts)
         page = pcgts.get_Page()
         oplevel = self.parameter['level-of-operation']
-        page_image, page_coords, page_image_info = self.workspace.image_from_page(
-            page, page_id, feature_filter='binarized')
+        page_image, page_coords, page_image_info = self._image_from_page(page, page_id)
         if self.parameter['dpi'] > 0:
             dpi = self.parameter['dpi']
             self.logger.info("Page '%s' images will use %d DPI from parameter override", page_id, dpi)
@@ -61,61 +273,44 @@ class SkimageNormalize(Processor):
             self.logger.info("Page '%s' images will use 300 DPI from fall-back", page_id)
 
         if oplevel == 'page':
-            image = self._process_segment(page, page_image, page_coords)
+            image = self._process_segment(page, page_image, page_coords, dpi)
             if image:
                 result.images.append(image)
             return result
+        if self.parameter['page_statistics']:
+            # normalize only once, and crop all segments from the result
+            page_image = Image.fromarray(self._normalize(page_image, page_coords, dpi))
 
-        regions = page.get_AllRegions(classes=['Text'])
-        if not regions:
-            self.logger.warning("Page '%s' contains no text regions", page_id)
-        for region in regions:
-            region_image, region_coords = self.workspace.image_from_segment(
-                region, page_image, page_coords, feature_filter='binarized')
-            if oplevel == 'region':
-                image = self._process_segment(region, region_image, region_coords)
-                if image:
-                    result.images.append(image)
-                continue
-
-            lines = region.get_TextLine()
-            if not lines:
-                self.logger.warning("Region '%s' contains no text lines", region.id)
-            for line in lines:
-                line_image, line_coords = self.workspace.image_from_segment(
-                    line, region_image, region_coords, feature_filter='binarized')
-                if oplevel == 'line':
-                    image = self._process_segment(line, line_image, line_coords)
-                    if image:
-                        result.images.append(image)
-                    continue
-
-                words = line.get_Word()
-                if not words:
-                    self.logger.warning("Line '%s' contains no words", line.id)
-                for word in words:
-                    word_image, word_coords = self.workspace.image_from_segment(
-                        word, line_image, line_coords, feature_filter='binarized')
-                    if oplevel == 'word':
-                        image = self._process_segment(word, word_image, word_coords)
-                        if image:
-                            result.images.append(image)
-                        continue
-
-                    glyphs = word.get_Glyph()
-                    if not glyphs:
-                        self.logger.warning("Word '%s' contains no glyphs", word.id)
-                    for glyph in glyphs:
-                        glyph_image, glyph_coords = self.workspace.image_from_segment(
-                            glyph, word_image, word_coords, feature_filter='binarized')
-                        image = self._process_segment(glyph, glyph_image, glyph_coords)
-                        if image:
-                            result.images.append(image)
+        for image in map_segments(
+                lambda segment, segment_image, segment_coords: self._process_segment(
+                    segment, segment_image, segment_coords, dpi),
+                iter_segments(self.workspace, self.logger, page, page_id, page_image, page_coords,
+                              oplevel, feature_filter='binarized'),
+                page_workers(self.parameter['max_threads'])):
+            if image:
+                result.images.append(image)
         return result
 
-    def _process_segment(self, segment, image, coords) -> Optional[OcrdPageResultImage]:
+    def _process_segment(self, segment, image, coords, dpi) -> Optional[OcrdPageResultImage]:
         features = coords['features'] # features already applied to image
         features += ',normalized'
+        if (self.parameter['page_statistics'] and
+            not isinstance(segment, PageType) and
+            self._cropped_from_page(segment)):
+            # already normalized along with the page image
+            return self._make_result(segment, np.asarray(image), features)
+        return self._make_result(segment, self._normalize(image, coords, dpi), features)
+
+    @staticmethod
+    def _cropped_from_page(segment) -> bool:
+        # (neither the segment nor its parents below the page have their own images)
+        while not isinstance(segment, PageType):
+            if selects_alternative_image(segment, feature_filter='binarized'):
+                return False
+            segment = segment.parent_object_
+        return True
+
+    def _normalize(self, image, coords, dpi) -> np.ndarray:
         method = self.parameter['method']
         black_point = self.parameter['black-point']
         white_point = self.parameter['white-point']
@@ -127,31 +322,95 @@ class SkimageNormalize(Processor):
         elif image.mode == 'LA':
             image = image.convert('L')
         rgb = image.mode == 'RGB'
-        array = img_as_float(image)
-        # Estimate the  noise standard deviation across color channels.
-        pctiles = np.percentile(array, (0.2, 99.8), axis=(0, 1))
-        self.logger.debug("2‰ percentiles before: %s", pctiles)
-        if method == 'stretch':
-            @adapt_rgb(hsv_value)
-            def normalize(a):
-                # defaults: stretch from in_range='image' to out_range='dtype'
-                v_min, v_max = np.percentile(a, (black_point, 100 - white_point))
-                return rescale_intensity(a, in_range=(v_min, v_max))
-            array = normalize(array)
-        elif method == 'adapthist':
-            # (implicitly does hsv_value when RGB)
-            # defaults: tiles with kernel_size 1/8 width and height
-            limit = min(black_point, white_point) / 100
-            array = equalize_adapthist(array, clip_limit=limit)
-        pctiles = np.percentile(array, (0.2, 99.8), axis=(0, 1))
-        self.logger.debug("2‰ percentiles after: %s", pctiles)
         if image.mode in ['F', 'I']:
-            array = img_as_uint(array)
+            convert = img_as_uint
+        else:
+            convert = img_as_ubyte
+        array = np.asarray(image)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            pctiles = np.percentile(img_as_float(array), (0.2, 99.8), axis=(0, 1))
+            self.logger.debug("2‰ percentiles before: %s", pctiles)
+        integer = array.dtype in [np.uint8, np.uint16]
+        limit = min(black_point, white_point) / 100
+        height, width = array.shape[:2]
+        kernel_size = self.parameter['kernel_size']
+        if kernel_size < 0:
+            # use 1x1 inch square
+            kernel_size = int(round(dpi))
+        if kernel_size:
+            kernel_size = (min(kernel_size, height), min(kernel_size, width))
+        else:
+            # default of equalize_adapthist: 1/8 of width and height
+            kernel_size = (max(height // 8, 1), max(width // 8, 1))
+        # float64 image, HSV copies and intermediate results
+        rows = strip_rows(array.shape, self.parameter['tile_memory'], 48)
+        if method == 'stretch' and integer:
+            array = stretch_integer(array, rgb, black_point, white_point, convert,
+                                    self.parameter['tile_memory'], self.parameter['hsv'])
+        elif method == 'adapthist' and integer and self.parameter['adapthist_engine'] == 'fast':
+            decimation = self.parameter['decimation']
+            if not decimation:
+                # use about 150 DPI
+                decimation = max(1, round(dpi / 150))
+            array = equalize_fast(array, rgb, kernel_size, limit, convert,
+                                  decimation, self.parameter['hsv'])
+        elif method == 'adapthist' and integer and rows < height and _clahe is not None:
+            array = self._equalize_tiled(array, rgb, kernel_size, limit, convert)
         else:
-            array = img_as_ubyte(array)
+            array = img_as_float(image)
+            if method == 'stretch':
+                @adapt_rgb(hsv_value)
+                def normalize(a):
+                    # defaults: stretch from in_range='image' to out_range='dtype'
+                    v_min, v_max = np.percentile(a, (black_point, 100 - white_point))
+                    return rescale_intensity(a, in_range=(v_min, v_max))
+                array = normalize(array)
+            elif method == 'adapthist':
+                # (implicitly does hsv_value when RGB)
+                array = equalize_adapthist(array, kernel_size=kernel_size, clip_limit=limit)
+            array = convert(array)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            pctiles = np.percentile(img_as_float(array), (0.2, 99.8), axis=(0, 1))
+            self.logger.debug("2‰ percentiles after: %s", pctiles)
+        return array
+
+    def _make_result(self, segment, array, features) -> OcrdPageResultImage:
         image = Image.fromarray(array)
         # update PAGE (reference the image file):
         image_ref = AlternativeImageType(comments=features)
         segment.add_AlternativeImage(image_ref)
         suffix = "" if isinstance(segment, PageType) else segment.id
         return OcrdPageResultImage(image, suffix + '.IMG-NRM', image_ref)
+
+    def _equalize_tiled(self, array, rgb, kernel_size, limit, convert):
+        memory = self.parameter['tile_memory']
+        height = array.shape[0]
+        rows = strip_rows(array.shape, memory, 48)
+        # value range in the whole image
+        v_min, v_max = np.iinfo(np.uint16).max, 0
+        for _, start, stop, _ in iter_strips(height, rows):
+            strip = img_as_uint(value_channel(array[start:stop], rgb))
+            v_min, v_max = min(v_min, strip.min()), max(v_max, strip.max())
+        def equalize(strip):
+            strip = img_as_uint(value_channel(strip, rgb))
+            strip = np.round(rescale_intensity(strip, in_range=(v_min, v_max),
+                                               out_range=(0, NR_OF_GRAY - 1)))
+            strip = strip.astype(np.min_scalar_type(NR_OF_GRAY))
+            return _clahe(strip, kernel_size, limit, 256)
+        # contextual regions from the neighbouring rows of tiles, and their interpolation
+        equalized = process_tiled(equalize, array, memory, pixel_bytes=48,
+                                  halo=2 * kernel_size[0], align=kernel_size[0])
+        # output range in the whole image
+        in_range = equalized.min(), equalized.max()
+        result = None
+        for _, start, stop, _ in iter_strips(height, rows):
+            strip = rescale_intensity(equalized[start:stop].astype(np.float64), in_range=in_range)
+            if rgb:
+                hsv = rgb2hsv(img_as_float(array[start:stop]))
+                hsv[:, :, 2] = strip
+                strip = hsv2rgb(hsv)
+            strip = convert(strip)
+            if result is None:
+                result = np.empty(array.shape, dtype=strip.dtype)
+            result[start:stop] = strip
+        return result
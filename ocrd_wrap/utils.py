@@ -0,0 +1,312 @@
+from __future__ import absolute_import
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from packaging.version import Version
+import PIL
+from shapely import prepare
+from shapely.geometry import Polygon
+from ocrd_utils import (
+    config,
+    bbox_from_polygon,
+    coordinates_of_segment,
+    polygon_from_points,
+    points_from_bbox,
+)
+
+
+def cpu_count() -> int:
+    """Number of CPU cores available to the current process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def page_workers(limit: int = 0) -> int:
+    """Number of concurrent workers to use within a single page.
+
+    If ``limit`` is positive, use exactly that. Otherwise share
+    the available cores with the page-parallel processing of
+    OCR-D core (``OCRD_MAX_PARALLEL_PAGES``), so the total number
+    of workers does not exceed the number of cores.
+    """
+    if limit > 0:
+        return limit
+    return max(1, cpu_count() // max(1, config.OCRD_MAX_PARALLEL_PAGES))
+
+def map_segments(func, segments, workers=1) -> list:
+    """Apply ``func`` to each tuple of arguments in ``segments``, with up to ``workers`` threads.
+
+    Submit each segment as soon as it is generated (e.g. by :py:func:`iter_segments`,
+    which then keeps running in the calling thread), and return the results in order.
+    """
+    if workers <= 1:
+        return [func(*segment) for segment in segments]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(func, *segment) for segment in segments]
+        return [future.result() for future in futures]
+
+def matches_features(alternative_image, feature_selector='', feature_filter='') -> bool:
+    """Whether the features of ``alternative_image`` satisfy ``feature_selector`` and ``feature_filter``."""
+    features = set((alternative_image.get_comments() or '').split(','))
+    return (all(feature in features for feature in feature_selector.split(',') if feature) and
+            not any(feature in features for feature in feature_filter.split(',') if feature))
+
+def selects_alternative_image(segment, feature_selector='', feature_filter='') -> bool:
+    """Whether ``image_from_segment`` would use an AlternativeImage of ``segment``.
+
+    Apply the same ``feature_selector`` and ``feature_filter`` semantics, so
+    if this is False, then the segment image is merely cropped (and possibly
+    rotated) from its parent's image.
+    """
+    return any(matches_features(alternative_image, feature_selector, feature_filter)
+               for alternative_image in segment.get_AlternativeImage())
+
+def iter_segments(workspace, logger, page, page_id, page_image, page_coords, level,
+                  feature_selector='', feature_filter=''):
+    """Iterate over all text segments of ``page`` at ``level``, along with their images.
+
+    Yield ``(segment, image, coords)`` for text regions, lines, words or glyphs
+    (or the page itself) in document order, like nested calls to
+    ``image_from_segment`` from ``page_image`` would (passing on ``feature_selector``
+    and ``feature_filter``), but without computing images on all intermediate levels.
+
+    A region, line or word becomes the parent image of its descendants only if
+    they depend on it: if it has an AlternativeImage (matching the features) or
+    an orientation, if it extends beyond its own parent, if any descendant on
+    the way extends beyond its polygon (into the masked background), or if the
+    image it would be cropped from was rotated. Such images are computed lazily
+    and at most once. Otherwise, crop directly from the nearest ancestor image
+    (or the page image), after cutting out the segment's bounding box, so
+    masking and background estimation only touch that area.
+
+    Log a warning for each segment without any children on the next level.
+    """
+    if level == 'page':
+        yield page, page_image, page_coords
+        return
+    kwargs = dict(feature_selector=feature_selector, feature_filter=feature_filter)
+    images = {}
+    polygons = {}
+    covered = {}
+    dependent = {}
+
+    def polygon(segment):
+        if id(segment) not in polygons:
+            if segment is page:
+                if page.get_Border():
+                    points = page.get_Border().get_Coords().points
+                else:
+                    points = points_from_bbox(0, 0, page.get_imageWidth(), page.get_imageHeight())
+            else:
+                points = segment.get_Coords().points
+            shape = Polygon(polygon_from_points(points))
+            if shape.is_valid:
+                prepare(shape)
+            else:
+                shape = None
+            polygons[id(segment)] = shape
+        return polygons[id(segment)]
+
+    def covers(parent, segment):
+        if (id(parent), id(segment)) not in covered:
+            outer, inner = polygon(parent), polygon(segment)
+            covered[id(parent), id(segment)] = (
+                outer is not None and inner is not None and outer.covers(inner))
+        return covered[id(parent), id(segment)]
+
+    def depends(segment, parent):
+        # whether descendants depend on the image of segment in any case
+        if id(segment) not in dependent:
+            dependent[id(segment)] = (
+                selects_alternative_image(segment, **kwargs) or
+                getattr(segment, 'orientation', None) is not None or
+                not covers(parent, segment))
+        return dependent[id(segment)]
+
+    def parent_of(segment, ancestors):
+        parent_image, parent_coords = page_image, page_coords
+        depth = 0
+        child = segment
+        # (coverage is transitive, so checking each ancestor against
+        #  its parent and its next descendant suffices)
+        for depth in reversed(range(len(ancestors))):
+            ancestor = ancestors[depth]
+            if (depends(ancestor, ancestors[depth - 1] if depth else page) or
+                not covers(ancestor, child)):
+                parent_image, parent_coords = image_of(ancestor, ancestors[:depth])
+                depth += 1
+                break
+            child = ancestor
+        if (depth < len(ancestors) and
+            not np.allclose(parent_coords['transform'][:2, :2], np.eye(2))):
+            # rotated polygons get rounded differently, so skip nothing
+            return image_of(ancestors[-1], ancestors[:-1])
+        return parent_image, parent_coords
+
+    def crop(segment, ancestors):
+        parent_image, parent_coords = crop_bbox(segment, *parent_of(segment, ancestors))
+        return workspace.image_from_segment(segment, parent_image, parent_coords, **kwargs)
+
+    def image_of(segment, ancestors):
+        if id(segment) not in images:
+            images[id(segment)] = crop(segment, ancestors)
+        return images[id(segment)]
+
+    levels = [
+        ('region', lambda segment: segment.get_AllRegions(classes=['Text']),
+         "Page '%s' contains no text regions"),
+        ('line', lambda segment: segment.get_TextLine(),
+         "Region '%s' contains no text lines"),
+        ('word', lambda segment: segment.get_Word(),
+         "Line '%s' contains no words"),
+        ('glyph', lambda segment: segment.get_Glyph(),
+         "Word '%s' contains no glyphs"),
+    ]
+    def walk(segment, ancestors, depth):
+        name, children, warning = levels[depth]
+        children = children(segment)
+        if not children:
+            logger.warning(warning, page_id if depth == 0 else segment.id)
+        for child in children:
+            if name == level:
+                yield (child,) + crop(child, ancestors)
+            else:
+                yield from walk(child, ancestors + [child], depth + 1)
+    yield from walk(page, [], 0)
+
+def crop_bbox(segment, parent_image, parent_coords):
+    """Cut out the bounding box of ``segment`` from its parent image (for ``image_from_segment``).
+
+    Keep one more row and column than the bounding box (which polygon masks
+    also cover), and clip to the parent image. Return the image and its coords.
+    """
+    left, top, right, bottom = bbox_from_polygon(
+        coordinates_of_segment(segment, parent_image, parent_coords))
+    left, top = max(0, left), max(0, top)
+    right, bottom = min(parent_image.width, right + 1), min(parent_image.height, bottom + 1)
+    if left >= right or top >= bottom:
+        return parent_image, parent_coords
+    coords = dict(parent_coords)
+    shift = np.eye(3)
+    shift[:2, 2] = -left, -top
+    # (like shift_coordinates, but without its debug logging)
+    coords['transform'] = shift @ parent_coords['transform']
+    return parent_image.crop((left, top, right, bottom)), coords
+
+def crop_page_array(page_array, page_coords, coords, shape):
+    """Crop the area of a segment image from an array computed on the page image.
+
+    Use the relative transform between ``page_coords`` and ``coords`` (as
+    returned by ``image_from_page`` and ``image_from_segment``) to find
+    the segment's ``shape`` in ``page_array``. Return None if the segment
+    image is no plain crop of the page image, i.e. if it was rotated or
+    has different features (like an AlternativeImage of its own), or
+    if it extends beyond the page.
+    """
+    offset = segment_offset(page_coords, coords, shape, page_array.shape)
+    if offset is None:
+        return None
+    left, top = offset
+    height, width = shape[:2]
+    return page_array[top:top + height, left:left + width]
+
+def segment_offset(page_coords, coords, shape, page_shape):
+    """Find the position of a segment image of ``shape`` within a page image of ``page_shape``.
+
+    Return the ``(left, top)`` offset of the segment image, or None if
+    it is no plain crop of the page image (cf. :py:func:`crop_page_array`).
+    """
+    def feature_set(coords):
+        return set(filter(None, coords['features'].split(',')))
+    if feature_set(coords) != feature_set(page_coords):
+        return None
+    transform = coords['transform'] @ np.linalg.inv(page_coords['transform'])
+    if not np.allclose(transform[:2, :2], np.eye(2)):
+        return None
+    left, top = -transform[:2, 2]
+    if not np.allclose([left, top], np.round([left, top])):
+        return None
+    left, top = int(round(left)), int(round(top))
+    height, width = shape[:2]
+    if (left < 0 or top < 0 or
+        top + height > page_shape[0] or
+        left + width > page_shape[1]):
+        return None
+    return left, top
+
+def strip_rows(shape, memory=0, pixel_bytes=8, halo=0, align=1) -> int:
+    """Number of rows per strip for processing an array of ``shape`` within a memory budget.
+
+    Assume processing needs ``pixel_bytes`` per sample (i.e. per pixel
+    and channel), and each strip is extended by ``halo`` rows on either
+    side. Return a multiple of ``align``, but at least ``align`` (even if
+    that exceeds the budget). If ``memory`` (in MB) is zero or the whole
+    array fits, return its full height.
+    """
+    height = shape[0]
+    if not memory:
+        return height
+    row_bytes = pixel_bytes * int(np.prod(shape[1:]))
+    rows = int(memory * 1024 * 1024 // row_bytes) - 2 * halo
+    if rows >= height:
+        return height
+    return max(align, rows // align * align)
+
+def iter_strips(height, rows, halo=0):
+    """Iterate over strips of ``rows`` rows in an array of ``height``.
+
+    Yield row indices ``top, start, stop, bottom``, where ``start:stop``
+    is the strip itself and ``top:bottom`` includes up to ``halo`` rows
+    of context on either side.
+    """
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        yield max(0, start - halo), start, stop, min(height, stop + halo)
+
+def process_tiled(func, array, memory=0, pixel_bytes=8, halo=0, align=1):
+    """Apply ``func`` to ``array`` in horizontal strips within a memory budget, and reassemble.
+
+    ``func`` must return an array with the same number of rows as its input.
+    Strips are extended by ``halo`` rows of context (rounded up to a multiple
+    of ``align``), which get cut off the results again. Strip offsets are
+    multiples of ``align``, so block-wise computations see the same grid.
+    (See :py:func:`strip_rows` for the budget.)
+    """
+    halo = -(-halo // align) * align
+    height = array.shape[0]
+    rows = strip_rows(array.shape, memory, pixel_bytes, halo, align)
+    if rows >= height:
+        return func(array)
+    result = None
+    for top, start, stop, bottom in iter_strips(height, rows, halo):
+        strip = func(array[top:bottom])
+        if result is None:
+            result = np.empty((height,) + strip.shape[1:], dtype=strip.dtype)
+        result[start:stop] = strip[start - top:stop - top]
+    return result
+
+# Pillow merges the encoderinfo set on an image into the options of save since 11.1
+PRESET_ENCODERINFO = Version(PIL.__version__) >= Version('11.1')
+
+def png_compression(image, level=-1):
+    """Make ``image`` encode with zlib compression ``level`` (0-9) when saved as PNG.
+
+    (The OCR-D core saves result images without any options, but Pillow
+    merges the ``encoderinfo`` set on the image - since 11.1, see
+    :py:func:`check_png_compression`; the page pipeline passes it on
+    explicitly. Negative ``level`` keeps the zlib default.)
+    """
+    if level >= 0:
+        image.encoderinfo = dict(getattr(image, 'encoderinfo', {}), compress_level=level)
+    return image
+
+def check_png_compression(logger, parameter):
+    """Warn if the ``compress_level`` of a processor's ``parameter`` cannot take effect."""
+    if (parameter['compress_level'] >= 0 and not PRESET_ENCODERINFO and
+        parameter['pipeline_pages'] <= 0):
+        logger.warning("Pillow %s ignores 'compress_level' when OCR-D core saves the images "
+                       "(needs Pillow>=11.1, or 'pipeline_pages' with sequential pages)",
+                       PIL.__version__)
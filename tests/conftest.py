@@ -2,9 +2,11 @@
 
 from multiprocessing import Process
 from time import sleep
+import numpy as np
 import pytest
+from PIL import Image
 
-from ocrd import Resolver, Workspace, OcrdMetsServer
+from ocrd import Resolver, Workspace, OcrdMetsServer, run_processor
 from ocrd_utils import pushd_popd, disableLogging, initLogging, setOverrideLogLevel, config
 
 from .assets import assets
@@ -61,3 +63,33 @@ def workspace_aufklaerung_region(workspace):
 @pytest.fixture
 def workspace_sbb(workspace):
     yield from workspace(assets.url_of('SBB0000F29300010000/data/mets_one_file.xml'))
+
+
+def assert_same_images(ws, file_grp, other_file_grp, message="result differs"):
+    """Compare all images of ``file_grp`` and ``other_file_grp`` pixel by pixel."""
+    # page-parallel processing adds files in arbitrary order
+    images = sorted(ws.find_files(fileGrp=file_grp, mimetype="//^image/.*"), key=lambda f: f.ID)
+    other_images = sorted(ws.find_files(fileGrp=other_file_grp, mimetype="//^image/.*"), key=lambda f: f.ID)
+    assert len(images) == len(other_images)
+    for image, other_image in zip(images, other_images):
+        array = np.array(Image.open(ws.download_file(image).local_filename))
+        other_array = np.array(Image.open(ws.download_file(other_image).local_filename))
+        assert np.array_equal(array, other_array), message
+
+def assert_tiled_identical(processor, workspace, input_file_grp, output_file_grp, memory, parameter=None):
+    """Run ``processor`` without and with ``tile_memory`` and compare the results.
+
+    Write the untiled results to ``output_file_grp`` and the tiled ones
+    to ``output_file_grp`` with suffix ``-TILED``. Return the workspace.
+    """
+    for grp, tile_memory in [(output_file_grp, 0), (output_file_grp + "-TILED", memory)]:
+        run_processor(processor,
+                      input_file_grp=input_file_grp,
+                      output_file_grp=grp,
+                      parameter=dict(parameter or {}, tile_memory=tile_memory),
+                      **workspace,
+        )
+    ws = workspace['workspace']
+    ws.save_mets()
+    assert_same_images(ws, output_file_grp, output_file_grp + "-TILED", "tiled result differs")
+    return ws
@@ -3,14 +3,27 @@
 import json
 import os
 
+import numpy as np
+import pytest
+from PIL import Image
+from skimage.filters import (
+    threshold_li,
+    threshold_niblack,
+    threshold_otsu,
+    threshold_sauvola,
+    threshold_yen
+)
+
 from ocrd import run_processor
 from ocrd_utils import MIMETYPE_PAGE
 from ocrd_models.constants import NAMESPACES
 from ocrd_modelfactory import page_from_file
 
 from ocrd_wrap.cli import SkimageBinarize
+from ocrd_wrap.skimage_binarize import ThresholdStatistics
 
 from .assets import assets
+from .conftest import assert_same_images, assert_tiled_identical
 
 
 PARAM_JSON = assets.url_of('param-binarize.json')
@@ -58,3 +71,110 @@ def test_lines(workspace_aufklaerung):
     ws = workspace_aufklaerung['workspace']
     ws.save_mets()
     analyse_result(ws, 'TextLine', 'OCR-D-BIN-SKIMAGE')
+
+def test_lines_page_threshold(workspace_aufklaerung):
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-BIN-SKIMAGE",
+                  parameter={'level-of-operation': 'line', 'page_threshold': True},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-BIN-SKIMAGE')
+
+def test_lines_sweep(workspace_aufklaerung):
+    sweep = [{'method': 'sauvola', 'k': 0.2},
+             {'method': 'sauvola', 'k': 0.5},
+             {'method': 'niblack', 'window_size': 51},
+             {'method': 'otsu'}]
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-BIN-SKIMAGE",
+                  parameter={'level-of-operation': 'line', 'sweep': sweep},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-BIN-SKIMAGE')
+    out_files = list(ws.find_files(fileGrp='OCR-D-BIN-SKIMAGE', mimetype=MIMETYPE_PAGE))
+    out_pcgts = page_from_file(out_files[0])
+    line = out_pcgts.etree.xpath('//page:TextLine', namespaces=NAMESPACES)[0]
+    comments = line.xpath('page:AlternativeImage/@comments', namespaces=NAMESPACES)
+    assert len(comments) == len(sweep)
+    assert len(set(comments)) == len(sweep), "variants are not distinguishable"
+    assert comments[-1].endswith(',binarized,otsu')
+
+@pytest.mark.parametrize("method", ["sauvola", "niblack", "otsu", "li", "yen"])
+def test_threshold_statistics(method):
+    image = Image.open(assets.path_to('kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif'))
+    array = np.array(image.convert('L'))
+    stats = ThresholdStatistics(array)
+    params = {'method': method, 'window_size': 101, 'k': 0.2}
+    if method == 'sauvola':
+        expected = threshold_sauvola(array, 101, 0.2)
+    elif method == 'niblack':
+        expected = threshold_niblack(array, 101, 0.2)
+    elif method == 'otsu':
+        expected = threshold_otsu(array)
+    elif method == 'li':
+        expected = threshold_li(array)
+    else:
+        expected = threshold_yen(array)
+    assert np.array_equal(stats.threshold(params), expected)
+
+@pytest.mark.parametrize("method", ["otsu", "li", "yen"])
+def test_threshold_statistics_segments(method):
+    image = Image.open(assets.path_to('kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif'))
+    array = np.array(image.convert('L'))
+    function = {'otsu': threshold_otsu, 'li': threshold_li, 'yen': threshold_yen}[method]
+    # line- and word-sized crops, and a uniform one
+    segments = [array[top:top + 40, left:left + width]
+                for top in range(0, array.shape[0] - 40, 97)
+                for left, width in [(100, 1000), (300, 80)]]
+    segments.append(np.full((30, 50), 255, dtype=np.uint8))
+    for segment in segments:
+        expected = function(segment.copy())
+        assert ThresholdStatistics(segment).threshold({'method': method}) == expected
+
+@pytest.mark.parametrize("method", ["sauvola", "niblack", "gauss"])
+def test_decimation(method):
+    for path in ['kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif',
+                 'kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0002.tif']:
+        array = np.array(Image.open(assets.path_to(path)).convert('L'))
+        params = {'method': method, 'window_size': 301, 'k': 0.34}
+        exact = array > ThresholdStatistics(array).threshold(params)
+        for factor in [2, 4]:
+            params['decimation'] = factor
+            approx = array > ThresholdStatistics(array).threshold(params)
+            rate = np.count_nonzero(approx != exact) / array.size
+            print("%s decimated by %d: %.4f%% of pixels differ on %s" % (
+                method, factor, 100 * rate, os.path.basename(path)))
+            assert rate < 0.01
+
+def test_words_threads(workspace_aufklaerung):
+    for grp, threads in [("OCR-D-BIN-SKIMAGE", 1), ("OCR-D-BIN-SKIMAGE-THREADS", 4)]:
+        run_processor(SkimageBinarize,
+                      input_file_grp="OCR-D-GT-PAGE",
+                      output_file_grp=grp,
+                      parameter={'level-of-operation': 'word', 'method': 'sauvola',
+                                 'max_threads': threads},
+                      **workspace_aufklaerung,
+        )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'Word', 'OCR-D-BIN-SKIMAGE-THREADS')
+    # same images, referenced in the same order
+    def references(grp):
+        files = sorted(ws.find_files(fileGrp=grp, mimetype=MIMETYPE_PAGE), key=lambda f: f.pageId)
+        return [image.get('filename').split('/')[-1].split('_', 1)[1]
+                for f in files for image in page_from_file(ws.download_file(f)).etree.xpath(
+                        '//page:AlternativeImage', namespaces=NAMESPACES)]
+    assert references("OCR-D-BIN-SKIMAGE-THREADS") == references("OCR-D-BIN-SKIMAGE")
+    assert_same_images(ws, "OCR-D-BIN-SKIMAGE", "OCR-D-BIN-SKIMAGE-THREADS", "threaded result differs")
+
+def test_page_tiled(workspace_aufklaerung):
+    ws = assert_tiled_identical(SkimageBinarize, workspace_aufklaerung,
+                                "OCR-D-GT-PAGE", "OCR-D-BIN-SKIMAGE", 60,
+                                {'level-of-operation': 'page'})
+    analyse_result(ws, 'Page', 'OCR-D-BIN-SKIMAGE-TILED')
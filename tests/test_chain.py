@@ -0,0 +1,110 @@
+# pylint: disable=import-error
+
+import os
+
+import numpy as np
+from PIL import Image
+
+from ocrd import run_processor
+from ocrd_utils import MIMETYPE_PAGE
+from ocrd_models.constants import NAMESPACES
+from ocrd_modelfactory import page_from_file
+
+from ocrd_wrap.cli import (
+    SkimageChain,
+    SkimageNormalize,
+    SkimageDenoiseRaw,
+    SkimageBinarize,
+    SkimageDenoise,
+)
+
+
+def final_images(ws, level, grp):
+    """Map each segment of ``level`` to the comments and array of its last AlternativeImage."""
+    assert os.path.isdir(os.path.join(ws.directory, grp))
+    files = sorted(ws.find_files(fileGrp=grp, mimetype=MIMETYPE_PAGE), key=lambda f: f.pageId)
+    assert len(files), "found no output PAGE file"
+    images = {}
+    for page_file in files:
+        pcgts = page_from_file(ws.download_file(page_file))
+        for segment in pcgts.etree.xpath('//page:%s' % level, namespaces=NAMESPACES):
+            image = segment.xpath('page:AlternativeImage', namespaces=NAMESPACES)[-1]
+            filename = os.path.join(ws.directory, image.get('filename'))
+            images[page_file.pageId, segment.get('id')] = (image.get('comments'),
+                                                          np.array(Image.open(filename)))
+    return images
+
+def test_lines(workspace_aufklaerung):
+    grp = "OCR-D-GT-PAGE"
+    for processor, out_grp in [(SkimageNormalize, "OCR-D-NRM"),
+                               (SkimageDenoiseRaw, "OCR-D-DEN-RAW"),
+                               (SkimageBinarize, "OCR-D-BIN"),
+                               (SkimageDenoise, "OCR-D-DEN")]:
+        run_processor(processor,
+                      input_file_grp=grp,
+                      output_file_grp=out_grp,
+                      parameter={'level-of-operation': 'line'},
+                      **workspace_aufklaerung,
+        )
+        grp = out_grp
+        if processor is SkimageBinarize:
+            # denoise needs a binarized page image to start from
+            run_processor(SkimageBinarize,
+                          input_file_grp=grp,
+                          output_file_grp="OCR-D-BIN-PAGE",
+                          **workspace_aufklaerung,
+            )
+            grp = "OCR-D-BIN-PAGE"
+    run_processor(SkimageChain,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-CHAIN",
+                  parameter={'level-of-operation': 'line'},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    expected = final_images(ws, 'TextLine', "OCR-D-DEN")
+    result = final_images(ws, 'TextLine', "OCR-D-CHAIN")
+    assert len(result) > 0
+    assert result.keys() == expected.keys()
+    for line_id, (comments, array) in result.items():
+        expected_comments, expected_array = expected[line_id]
+        assert comments == expected_comments, line_id
+        assert 'binarized' in comments.split(',')
+        assert np.array_equal(array, expected_array), "chained result differs for %s" % line_id
+    # only the final images were written
+    images = list(ws.find_files(fileGrp="OCR-D-CHAIN", mimetype="//^image/.*"))
+    assert len(images) == len(result)
+
+def test_regions_intermediates(workspace_aufklaerung):
+    run_processor(SkimageChain,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-CHAIN",
+                  parameter={'level-of-operation': 'region',
+                             'steps': ['normalize', 'binarize', 'denoise'],
+                             'binarize': {'method': 'otsu'},
+                             'intermediates': True},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    regions = []
+    for page_file in ws.find_files(fileGrp="OCR-D-CHAIN", mimetype=MIMETYPE_PAGE):
+        pcgts = page_from_file(ws.download_file(page_file))
+        regions.extend(pcgts.etree.xpath('//page:TextRegion', namespaces=NAMESPACES))
+    assert len(regions) > 0
+    for region in regions:
+        images = region.xpath('page:AlternativeImage', namespaces=NAMESPACES)
+        assert len(images) in [2, 3]
+        features = [image.get('comments').split(',') for image in images]
+        assert 'normalized' in features[0]
+        assert 'binarized' not in features[0]
+        # features accumulate
+        for before, after in zip(features, features[1:]):
+            assert after[:len(before)] == before
+        assert 'binarized' in features[1]
+        for image in images:
+            assert os.path.exists(os.path.join(ws.directory, image.get('filename')))
+    images = list(ws.find_files(fileGrp="OCR-D-CHAIN", mimetype="//^image/.*"))
+    assert len(images) == sum(len(region.xpath('page:AlternativeImage', namespaces=NAMESPACES))
+                              for region in regions)
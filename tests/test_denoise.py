@@ -1,16 +1,33 @@
 # pylint: disable=import-error
 
+import io
 import json
 import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
 
 from ocrd import run_processor
-from ocrd_utils import MIMETYPE_PAGE
+from ocrd_utils import (
+    MIMETYPE_PAGE,
+    bbox_from_polygon,
+    config,
+    points_from_polygon,
+    polygon_from_points,
+    polygon_mask,
+)
 from ocrd_models.constants import NAMESPACES
+from ocrd_models.ocrd_page import to_xml
 from ocrd_modelfactory import page_from_file
 
 from ocrd_wrap.cli import SkimageDenoise, SkimageBinarize
+from ocrd_wrap import skimage_denoise
+from ocrd_wrap.skimage_denoise import protect_components, small_components
 
 from .assets import assets
+from .conftest import assert_tiled_identical
 
 
 PARAM_JSON = assets.url_of('param-binarize.json')
@@ -73,3 +90,175 @@ def test_lines(workspace_aufklaerung):
     ws = workspace_aufklaerung['workspace']
     ws.save_mets()
     analyse_result(ws, 'TextLine', 'OCR-D-DEN-SKIMAGE')
+
+def test_lines_page_components(workspace_aufklaerung):
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    run_processor(SkimageDenoise,
+                  input_file_grp="OCR-D-GT-PAGE-BIN",
+                  output_file_grp="OCR-D-DEN-SKIMAGE",
+                  parameter={'level-of-operation': 'line', 'page_components': True},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-DEN-SKIMAGE')
+
+def test_lines_page_components_polygon(workspace_aufklaerung):
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    # make the first line a triangle spanning all lines of its region
+    page_file = next(ws.find_files(fileGrp="OCR-D-GT-PAGE-BIN", pageId="PHYS_0001", mimetype=MIMETYPE_PAGE))
+    pcgts = page_from_file(ws.download_file(page_file))
+    region = pcgts.get_Page().get_TextRegion()[0]
+    line = region.get_TextLine()[0]
+    polygon = polygon_from_points(region.get_Coords().points)
+    x0, y0, x1, y1 = bbox_from_polygon(polygon)
+    polygon = [[x0, y0], [x1, y0], [x0, y1]]
+    line.get_Coords().set_points(points_from_polygon(polygon))
+    with open(os.path.join(ws.directory, page_file.local_filename), 'w') as page_xml:
+        page_xml.write(to_xml(pcgts))
+    for grp, page_components in [("OCR-D-DEN-SKIMAGE", False), ("OCR-D-DEN-SKIMAGE-PAGE", True)]:
+        run_processor(SkimageDenoise,
+                      input_file_grp="OCR-D-GT-PAGE-BIN",
+                      output_file_grp=grp,
+                      parameter={'level-of-operation': 'line', 'page_components': page_components,
+                                 # large enough for the counters of glyphs
+                                 'maxsize': 3},
+                      **workspace_aufklaerung,
+        )
+    ws.save_mets()
+    arrays = []
+    for grp in ["OCR-D-DEN-SKIMAGE", "OCR-D-DEN-SKIMAGE-PAGE"]:
+        page_file = next(ws.find_files(fileGrp=grp, pageId="PHYS_0001", mimetype=MIMETYPE_PAGE))
+        filename = page_from_file(ws.download_file(page_file)).etree.xpath(
+            '//page:TextLine[@id="%s"]/page:AlternativeImage/@filename' % line.id, namespaces=NAMESPACES)[-1]
+        arrays.append(np.array(Image.open(os.path.join(ws.directory, filename))))
+    array, page_array = arrays
+    assert array.shape == page_array.shape
+    inside = np.array(polygon_mask(Image.fromarray(array), np.array(polygon) - [x0, y0])).astype(bool)
+    assert not inside.all()
+    # nothing from other lines' components outside the polygon
+    assert np.array_equal(array[~inside], page_array[~inside])
+
+def test_lines_page_components_labels(workspace_aufklaerung, monkeypatch):
+    if config.OCRD_MAX_PARALLEL_PAGES > 1:
+        pytest.skip("labelling cannot be counted in other processes")
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    calls = []
+    def counting_small_components(array, maxsize):
+        calls.append(array.shape)
+        return small_components(array, maxsize)
+    monkeypatch.setattr(skimage_denoise, 'small_components', counting_small_components)
+    run_processor(SkimageDenoise,
+                  input_file_grp="OCR-D-GT-PAGE-BIN",
+                  output_file_grp="OCR-D-DEN-SKIMAGE",
+                  parameter={'level-of-operation': 'line', 'page_components': True},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-DEN-SKIMAGE')
+    # labelled once per page, no segment labelled separately
+    pages = list(ws.find_files(fileGrp="OCR-D-DEN-SKIMAGE", mimetype=MIMETYPE_PAGE))
+    assert len(calls) == len(pages)
+
+def test_page_tiled(workspace_aufklaerung):
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    ws = assert_tiled_identical(SkimageDenoise, workspace_aufklaerung,
+                                "OCR-D-GT-PAGE-BIN", "OCR-D-DEN-SKIMAGE", 10,
+                                {'level-of-operation': 'page'})
+    analyse_result(ws, 'Page', 'OCR-D-DEN-SKIMAGE-TILED')
+
+@pytest.mark.parametrize("dpi", [300, 600])
+@pytest.mark.parametrize("protect", [1, 2])
+def test_protect_speed(dpi, protect):
+    image = Image.open(assets.path_to('kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif'))
+    image = image.convert('L')
+    if dpi == 600:
+        image = image.resize((2 * image.width, 2 * image.height))
+    array = np.array(image) > 128
+    # integer radius in px (for identical results)
+    protect = round(protect * dpi / 72)
+    holes, specks = small_components(array, protect ** 2)
+    array1 = ~array | holes
+    array2 = array1 & ~specks
+    results = {}
+    for method in ["dilation", "distance"]:
+        start = time.perf_counter()
+        results[method] = protect_components(array1, array2, protect, method)
+        duration = time.perf_counter() - start
+        print("protect %dpx at %d DPI (%s): %.1fms" % (protect, dpi, method, 1e3 * duration))
+    assert np.array_equal(results["dilation"], results["distance"])
+
+def test_page_output_1bit(workspace_aufklaerung):
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-BIN",
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    # like binarizers which write 8-bit images
+    for image in ws.find_files(fileGrp='OCR-D-GT-PAGE-BIN', mimetype="//^image/.*"):
+        filename = ws.download_file(image).local_filename
+        Image.open(filename).convert('L').save(filename)
+    for grp, params in [("OCR-D-DEN-SKIMAGE", {}),
+                        ("OCR-D-DEN-SKIMAGE-1BIT", {'output_1bit': True, 'compress_level': 1})]:
+        run_processor(SkimageDenoise,
+                      input_file_grp="OCR-D-GT-PAGE-BIN",
+                      output_file_grp=grp,
+                      parameter=dict(params, **{'level-of-operation': 'page'}),
+                      **workspace_aufklaerung,
+        )
+    ws.save_mets()
+    analyse_result(ws, 'Page', 'OCR-D-DEN-SKIMAGE-1BIT')
+    images = sorted(ws.find_files(fileGrp='OCR-D-DEN-SKIMAGE', mimetype="//^image/.*"), key=lambda f: f.ID)
+    bilevel_images = sorted(ws.find_files(fileGrp='OCR-D-DEN-SKIMAGE-1BIT', mimetype="//^image/.*"), key=lambda f: f.ID)
+    assert len(images) == len(bilevel_images)
+    for image, bilevel_image in zip(images, bilevel_images):
+        image = Image.open(ws.download_file(image).local_filename)
+        bilevel_image = Image.open(ws.download_file(bilevel_image).local_filename)
+        assert image.mode == 'L'
+        assert bilevel_image.mode == '1'
+        assert np.array_equal(np.array(image) > 0, np.array(bilevel_image))
+
+@pytest.mark.parametrize("dpi", [300, 600])
+def test_encoding_speed(dpi):
+    image = Image.open(assets.path_to('kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif'))
+    image = image.convert('L')
+    if dpi == 600:
+        image = image.resize((2 * image.width, 2 * image.height))
+    array = np.array(image) > 128
+    sizes = {}
+    for name, mode, options in [("8-bit PNG", 'L', {'format': 'PNG'}),
+                                ("1-bit PNG", '1', {'format': 'PNG'}),
+                                ("1-bit PNG level 1", '1', {'format': 'PNG', 'compress_level': 1}),
+                                ("1-bit PNG level 9", '1', {'format': 'PNG', 'compress_level': 9}),
+                                ("1-bit TIFF G4", '1', {'format': 'TIFF', 'compression': 'group4'})]:
+        if mode == 'L':
+            image = Image.fromarray(array.astype(np.uint8) * 255)
+        else:
+            image = Image.fromarray(array)
+        start = time.perf_counter()
+        data = io.BytesIO()
+        image.save(data, **options)
+        duration = time.perf_counter() - start
+        sizes[name] = len(data.getvalue())
+        print("%s at %d DPI: %.1fms, %d bytes" % (name, dpi, 1e3 * duration, sizes[name]))
+    assert sizes["1-bit PNG"] < sizes["8-bit PNG"]
+    assert sizes["1-bit PNG level 9"] <= sizes["1-bit PNG level 1"]
@@ -3,14 +3,21 @@
 import json
 import os
 
+import numpy as np
+import pytest
+from PIL import Image
+from skimage.restoration import estimate_sigma
+
 from ocrd import run_processor
 from ocrd_utils import MIMETYPE_PAGE
 from ocrd_models.constants import NAMESPACES
 from ocrd_modelfactory import page_from_file
 
 from ocrd_wrap.cli import SkimageDenoiseRaw
+from ocrd_wrap.skimage_denoise_raw import PageNoise, raw_array, sample_sigma
 
 from .assets import assets
+from .conftest import assert_tiled_identical
 
 
 PARAM_JSON = assets.url_of('param-binarize.json')
@@ -58,3 +65,55 @@ def test_lines(workspace_aufklaerung):
     ws = workspace_aufklaerung['workspace']
     ws.save_mets()
     analyse_result(ws, 'TextLine', 'OCR-D-DEN-SKIMAGE')
+
+def test_lines_sampled(workspace_aufklaerung):
+    run_processor(SkimageDenoiseRaw,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-DEN-SKIMAGE",
+                  parameter={'level-of-operation': 'line', 'sample_fraction': 0.25},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-DEN-SKIMAGE')
+
+@pytest.mark.parametrize("mode", ["L", "RGB"])
+@pytest.mark.parametrize("path", ['kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif',
+                                  'kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0002.tif'])
+def test_sample_sigma(path, mode):
+    array, rgb = raw_array(Image.open(assets.path_to(path)).convert(mode))
+    expected = estimate_sigma(array, channel_axis=-1 if rgb else None, average_sigmas=rgb)
+    assert sample_sigma(array, rgb) == expected
+    # in strips (as when tiled)
+    assert sample_sigma(array, rgb, rows=100) == expected
+    assert PageNoise(array, rgb, {}, 100).sigma() == expected
+    for fraction in [0.5, 0.25, 0.1]:
+        sigma = sample_sigma(array, rgb, fraction)
+        print("sigma from %g of %s (%s): %.2f (full: %.2f)" % (
+            fraction, os.path.basename(path), mode, sigma, expected))
+        assert abs(sigma - expected) < 0.02 * expected
+        assert sample_sigma(array, rgb, fraction, 200) == sigma
+
+@pytest.mark.parametrize("mode", ["L", "RGB"])
+def test_page_noise(mode):
+    image = Image.open(assets.path_to('kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif')).convert(mode)
+    array, rgb = raw_array(image)
+    page_coords = {'transform': np.eye(3), 'features': ''}
+    page_noise = PageNoise(array, rgb, page_coords)
+    for left, top, width, height in [(200, 300, 800, 60), (501, 1001, 333, 97), (0, 0, 600, 600)]:
+        coords = {'transform': np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]]), 'features': ''}
+        segment = array[top:top + height, left:left + width]
+        expected = estimate_sigma(segment, channel_axis=-1 if rgb else None, average_sigmas=rgb)
+        sigma = page_noise.sigma(coords, segment.shape)
+        print("sigma of %dx%d+%d+%d from page: %.2f (segment: %.2f)" % (
+            width, height, left, top, sigma, expected))
+        assert abs(sigma - expected) < 0.05 * expected
+    # no plain crop
+    coords = {'transform': np.eye(3), 'features': ',deskewed'}
+    assert page_noise.sigma(coords, (60, 800)) is None
+
+def test_page_tiled(workspace_aufklaerung):
+    ws = assert_tiled_identical(SkimageDenoiseRaw, workspace_aufklaerung,
+                                "OCR-D-GT-PAGE", "OCR-D-DEN-SKIMAGE", 20,
+                                {'level-of-operation': 'page'})
+    analyse_result(ws, 'Page', 'OCR-D-DEN-SKIMAGE-TILED')
@@ -2,15 +2,25 @@
 
 import json
 import os
+import time
 
-from ocrd import run_processor
+import numpy as np
+import pytest
+from PIL import Image
+from skimage import img_as_float, img_as_ubyte
+from skimage.color.adapt_rgb import adapt_rgb, hsv_value
+from skimage.exposure import equalize_adapthist, rescale_intensity
+
+from ocrd import Resolver, run_processor
 from ocrd_utils import MIMETYPE_PAGE
 from ocrd_models.constants import NAMESPACES
 from ocrd_modelfactory import page_from_file
 
 from ocrd_wrap.cli import SkimageNormalize
+from ocrd_wrap.skimage_normalize import equalize_fast, stretch_integer
 
 from .assets import assets
+from .conftest import assert_tiled_identical
 
 
 PARAM_JSON = assets.url_of('param-binarize.json')
@@ -58,3 +68,119 @@ def test_lines(workspace_aufklaerung):
     ws = workspace_aufklaerung['workspace']
     ws.save_mets()
     analyse_result(ws, 'TextLine', 'OCR-D-NRM-SKIMAGE')
+
+def test_lines_page_statistics(workspace_aufklaerung):
+    for grp, oplevel in [("OCR-D-NRM-SKIMAGE-PAGE", 'page'), ("OCR-D-NRM-SKIMAGE", 'line')]:
+        run_processor(SkimageNormalize,
+                      input_file_grp="OCR-D-GT-PAGE",
+                      output_file_grp=grp,
+                      parameter={'level-of-operation': oplevel,
+                                 'page_statistics': True},
+                      **workspace_aufklaerung,
+        )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-NRM-SKIMAGE')
+    # line images must be plain crops of the normalized page image
+    for page_file in ws.find_files(fileGrp='OCR-D-NRM-SKIMAGE-PAGE', mimetype=MIMETYPE_PAGE):
+        page = page_from_file(ws.download_file(page_file)).get_Page()
+        page_image, page_coords, _ = ws.image_from_page(page, page_file.pageId,
+                                                        feature_selector='normalized')
+        line_file = next(ws.find_files(fileGrp='OCR-D-NRM-SKIMAGE', pageId=page_file.pageId,
+                                       mimetype=MIMETYPE_PAGE))
+        lines = page_from_file(ws.download_file(line_file)).get_Page().get_AllTextLines()
+        for line, page_line in zip(lines, page.get_AllTextLines()):
+            features = line.get_AlternativeImage()[-1].get_comments().split(',')
+            assert features.count('normalized') == 1
+            line_image = Image.open(os.path.join(
+                ws.directory, line.get_AlternativeImage()[-1].get_filename()))
+            expected, _ = ws.image_from_segment(page_line, page_image, page_coords)
+            assert np.array_equal(np.array(line_image), np.array(expected))
+
+def test_lines_fast(workspace_aufklaerung):
+    run_processor(SkimageNormalize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-NRM-SKIMAGE",
+                  parameter={'level-of-operation': 'line',
+                             'method': 'adapthist',
+                             'adapthist_engine': 'fast',
+                             'kernel_size': -1},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-NRM-SKIMAGE')
+
+def test_page_tiled(workspace_aufklaerung):
+    ws = assert_tiled_identical(SkimageNormalize, workspace_aufklaerung,
+                                "OCR-D-GT-PAGE", "OCR-D-NRM-SKIMAGE", 20,
+                                {'level-of-operation': 'page'})
+    analyse_result(ws, 'Page', 'OCR-D-NRM-SKIMAGE-TILED')
+
+def test_page_tiled_adapthist(workspace_aufklaerung):
+    ws = assert_tiled_identical(SkimageNormalize, workspace_aufklaerung,
+                                "OCR-D-GT-PAGE", "OCR-D-NRM-SKIMAGE", 20,
+                                {'level-of-operation': 'page', 'method': 'adapthist'})
+    analyse_result(ws, 'Page', 'OCR-D-NRM-SKIMAGE-TILED')
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "I;16"])
+def test_stretch_integer(mode):
+    image = Image.open(assets.path_to('kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif'))
+    image = image.convert('L')
+    if mode == 'RGB':
+        image = Image.merge('RGB', [image, image.point(lambda v: min(255, v + 20)),
+                                    image.point(lambda v: v // 2)])
+    elif mode == 'I;16':
+        image = Image.fromarray(np.array(image).astype(np.uint16) * 257)
+    for black_point, white_point in [(1.0, 7.0), (0.0, 0.0), (3.3, 12.1)]:
+        @adapt_rgb(hsv_value)
+        def normalize(a):
+            v_min, v_max = np.percentile(a, (black_point, 100 - white_point))
+            return rescale_intensity(a, in_range=(v_min, v_max))
+        expected = img_as_ubyte(normalize(img_as_float(image)))
+        result = stretch_integer(np.asarray(image), mode == 'RGB',
+                                 black_point, white_point, img_as_ubyte, hsv=True)
+        assert np.array_equal(result, expected)
+        if mode == 'RGB':
+            # scaling by the value ratio differs by rounding only
+            result = stretch_integer(np.asarray(image), True,
+                                     black_point, white_point, img_as_ubyte)
+            assert np.abs(result.astype(int) - expected).max() <= 1
+
+def test_stretch_rgb_speed(tmpdir):
+    ws = Resolver().workspace_from_url(assets.url_of('SBB0000F29300010000/data/mets_one_file.xml'),
+                                       dst_dir=str(tmpdir), download=True)
+    image_file = next(ws.find_files(fileGrp="OCR-D-IMG", mimetype="//^image/.*"))
+    image = Image.open(os.path.join(ws.directory, image_file.local_filename)).convert('RGB')
+    array = np.asarray(image)
+    megapixels = image.width * image.height / 1e6
+    results = {}
+    for hsv in [True, False]:
+        start = time.perf_counter()
+        results[hsv] = stretch_integer(array, True, 1.0, 7.0, img_as_ubyte, hsv=hsv)
+        duration = time.perf_counter() - start
+        print("stretch RGB (%s): %.1fms/MP" % ("hsv" if hsv else "ratio", 1e3 * duration / megapixels))
+    diff = np.abs(results[True].astype(int) - results[False])
+    print("%.3f%% of samples differ" % (100 * np.count_nonzero(diff) / diff.size))
+    assert diff.max() <= 1
+
+@pytest.mark.parametrize("mode", ["L", "RGB"])
+def test_equalize_fast(mode):
+    image = Image.open(assets.path_to('kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif'))
+    image = image.convert(mode)
+    array = np.asarray(image)
+    kernel_size = (max(image.height // 8, 1), max(image.width // 8, 1))
+    megapixels = image.width * image.height / 1e6
+    start = time.perf_counter()
+    expected = img_as_ubyte(equalize_adapthist(img_as_float(array), kernel_size=kernel_size, clip_limit=0.01))
+    duration = time.perf_counter() - start
+    print("equalize_adapthist %s: %.1fms/MP" % (mode, 1e3 * duration / megapixels))
+    for decimation in [1, 2]:
+        start = time.perf_counter()
+        result = equalize_fast(array, mode == 'RGB', kernel_size, 0.01, img_as_ubyte, decimation)
+        duration = time.perf_counter() - start
+        print("equalize_fast %s (decimation %d): %.1fms/MP" % (mode, decimation, 1e3 * duration / megapixels))
+        assert result.shape == expected.shape
+        assert result.dtype == expected.dtype
+        diff = np.abs(result.astype(int) - expected)
+        assert diff.mean() < 3
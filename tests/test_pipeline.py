@@ -0,0 +1,165 @@
+# pylint: disable=import-error
+
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from ocrd import Workspace, run_processor
+from ocrd.processor import base as processor_base
+from ocrd_utils import MIMETYPE_PAGE, config, make_file_id
+from ocrd_models.constants import NAMESPACES
+from ocrd_modelfactory import page_from_file
+
+from ocrd_wrap.cli import SkimageBinarize, SkimageDenoise
+
+
+def output_files(ws, grp):
+    """List the pageId, ID suffix and local file of all output files of ``grp`` in order."""
+    files = sorted(ws.find_files(fileGrp=grp), key=lambda f: (f.pageId, f.ID))
+    return [(f.pageId, f.ID[len(grp):], ws.download_file(f).local_filename) for f in files]
+
+def test_lines(workspace_aufklaerung):
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-BIN",
+                  **workspace_aufklaerung,
+    )
+    for grp, pages in [("OCR-D-DEN", 0), ("OCR-D-DEN-PIPELINE", 1), ("OCR-D-DEN-PIPELINE2", 2)]:
+        run_processor(SkimageDenoise,
+                      input_file_grp="OCR-D-BIN",
+                      output_file_grp=grp,
+                      parameter={'level-of-operation': 'line', 'pipeline_pages': pages},
+                      **workspace_aufklaerung,
+        )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    expected = output_files(ws, "OCR-D-DEN")
+    assert len(expected) > 2
+    for grp in ["OCR-D-DEN-PIPELINE", "OCR-D-DEN-PIPELINE2"]:
+        result = output_files(ws, grp)
+        assert [f[:2] for f in result] == [f[:2] for f in expected]
+        for (page_id, suffix, filename), (_, _, expected_filename) in zip(result, expected):
+            assert os.path.exists(filename), filename
+            if suffix.endswith('.IMG-DEN'):
+                assert np.array_equal(np.array(Image.open(filename)),
+                                      np.array(Image.open(expected_filename))), suffix
+            else:
+                images = page_from_file(ws.download_file(next(ws.find_files(
+                    fileGrp=grp, pageId=page_id, mimetype=MIMETYPE_PAGE)))).etree.xpath(
+                        '//page:AlternativeImage/@filename', namespaces=NAMESPACES)
+                assert all(os.path.exists(os.path.join(ws.directory, image)) for image in images)
+
+def test_page_error(workspace_aufklaerung):
+    ws = workspace_aufklaerung['workspace']
+    # input image of the second page is missing
+    page_file = next(ws.find_files(fileGrp="OCR-D-GT-PAGE", pageId="PHYS_0002", mimetype=MIMETYPE_PAGE))
+    page = page_from_file(ws.download_file(page_file)).get_Page()
+    os.remove(os.path.join(ws.directory, page.get_imageFilename()))
+    with pytest.raises(Exception):
+        run_processor(SkimageBinarize,
+                      input_file_grp="OCR-D-GT-PAGE",
+                      output_file_grp="OCR-D-BIN",
+                      parameter={'pipeline_pages': 1},
+                      **workspace_aufklaerung,
+        )
+    # the first page was completed nevertheless
+    assert next(ws.find_files(fileGrp="OCR-D-BIN", pageId="PHYS_0001", mimetype=MIMETYPE_PAGE), None)
+    assert not next(ws.find_files(fileGrp="OCR-D-BIN", pageId="PHYS_0002", mimetype=MIMETYPE_PAGE), None)
+
+def test_write_error(workspace_aufklaerung):
+    config.OCRD_MISSING_OUTPUT = 'SKIP'
+    config.OCRD_MAX_MISSING_OUTPUTS = -1
+    ws = workspace_aufklaerung['workspace']
+    # PAGE output of the first page cannot be written
+    input_file = next(ws.find_files(fileGrp="OCR-D-GT-PAGE", pageId="PHYS_0001", mimetype=MIMETYPE_PAGE))
+    os.makedirs(os.path.join(ws.directory, "OCR-D-BIN", make_file_id(input_file, "OCR-D-BIN") + '.xml'))
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-BIN",
+                  parameter={'pipeline_pages': 1},
+                  **workspace_aufklaerung,
+    )
+    ws.save_mets()
+    # the second page is not affected
+    output_file = next(ws.find_files(fileGrp="OCR-D-BIN", pageId="PHYS_0002", mimetype=MIMETYPE_PAGE))
+    images = page_from_file(ws.download_file(output_file)).etree.xpath(
+        '//page:AlternativeImage/@filename', namespaces=NAMESPACES)
+    assert len(images) == 1
+    assert os.path.exists(os.path.join(ws.directory, images[0]))
+
+def test_in_place(workspace_aufklaerung):
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-BIN",
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    page_ids = sorted(f.ID for f in ws.find_files(fileGrp="OCR-D-BIN", mimetype=MIMETYPE_PAGE))
+    config.OCRD_EXISTING_OUTPUT = 'OVERWRITE'
+    run_processor(SkimageDenoise,
+                  input_file_grp="OCR-D-BIN",
+                  output_file_grp="OCR-D-BIN",
+                  parameter={'level-of-operation': 'line', 'pipeline_pages': 1},
+                  **workspace_aufklaerung,
+    )
+    ws.save_mets()
+    # the PAGE files have been replaced under the same IDs
+    page_files = sorted(ws.find_files(fileGrp="OCR-D-BIN", mimetype=MIMETYPE_PAGE), key=lambda f: f.ID)
+    assert [f.ID for f in page_files] == page_ids
+    for page_file in page_files:
+        images = page_from_file(ws.download_file(page_file)).etree.xpath(
+            '//page:TextLine/page:AlternativeImage/@filename', namespaces=NAMESPACES)
+        assert len(images)
+        assert all(image.startswith(os.path.join("OCR-D-BIN", page_file.ID + '_')) for image in images)
+        assert all(os.path.exists(os.path.join(ws.directory, image)) for image in images)
+
+def test_abort(workspace_aufklaerung):
+    if config.OCRD_MAX_PARALLEL_PAGES > 1:
+        pytest.skip("pages are not pipelined when processed in parallel")
+    config.OCRD_MISSING_OUTPUT = 'ABORT'
+    ws = workspace_aufklaerung['workspace']
+    # input image of the first page is missing
+    page_file = next(ws.find_files(fileGrp="OCR-D-GT-PAGE", pageId="PHYS_0001", mimetype=MIMETYPE_PAGE))
+    page = page_from_file(ws.download_file(page_file)).get_Page()
+    os.remove(os.path.join(ws.directory, page.get_imageFilename()))
+    with pytest.raises(Exception):
+        run_processor(SkimageBinarize,
+                      input_file_grp="OCR-D-GT-PAGE",
+                      output_file_grp="OCR-D-BIN",
+                      parameter={'pipeline_pages': 1},
+                      **workspace_aufklaerung,
+        )
+    # the second page was computed ahead, but left no output
+    assert not list(ws.find_files(fileGrp="OCR-D-BIN"))
+    directory = os.path.join(ws.directory, "OCR-D-BIN")
+    assert not os.path.isdir(directory) or not os.listdir(directory)
+
+def test_prefetch(workspace_aufklaerung, monkeypatch):
+    if config.OCRD_MAX_PARALLEL_PAGES > 1:
+        pytest.skip("pages are not pipelined when processed in parallel")
+    ws = workspace_aufklaerung['workspace']
+    page_ids = sorted(f.pageId for f in ws.find_files(fileGrp="OCR-D-GT-PAGE", mimetype=MIMETYPE_PAGE))
+    assert len(page_ids) > 1
+    parsed = []
+    opened = []
+    def counting_page_from_file(input_file, **kwargs):
+        parsed.append(input_file.pageId)
+        return page_from_file(input_file, **kwargs)
+    apply_mets_file = Workspace._apply_mets_file
+    def counting_apply_mets_file(self, filename_or_url, fun):
+        if fun is Image.open:
+            opened.append(filename_or_url)
+        return apply_mets_file(self, filename_or_url, fun)
+    monkeypatch.setattr(processor_base, 'page_from_file', counting_page_from_file)
+    monkeypatch.setattr(Workspace, '_apply_mets_file', counting_apply_mets_file)
+    run_processor(SkimageBinarize,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-BIN",
+                  parameter={'pipeline_pages': 1},
+                  **workspace_aufklaerung,
+    )
+    # only the first page was parsed and decoded by the processor itself
+    assert parsed == page_ids[:1]
+    assert len(opened) == 1
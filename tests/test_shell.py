@@ -1,14 +1,23 @@
 # pylint: disable=import-error
 
+from io import BytesIO
 import json
 import os
+import shlex
+import subprocess
+import sys
+import time
+
+import pytest
+from PIL import Image
 
 from ocrd import run_processor
-from ocrd_utils import MIMETYPE_PAGE
+from ocrd_utils import MIMETYPE_PAGE, getLogger
 from ocrd_models.constants import NAMESPACES
 from ocrd_modelfactory import page_from_file
 
 from ocrd_wrap.cli import ShellPreprocessor
+from ocrd_wrap.shell import PRLIMIT, ResultCache, encode_image, limit_command, split_command
 
 from .assets import assets
 
@@ -21,6 +30,29 @@ PARAM = {
     "output_feature_added": "dummy",
 }
 
+# identity filter speaking the coprocess protocol
+COPROCESS = """
+import sys
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+for header in stdin:
+    data = stdin.read(int(header))
+    stdout.write(b"%d\\n" % len(data) + data)
+    stdout.flush()
+"""
+
+# identity filter speaking the coprocess protocol, but using CPU time for each answer
+COPROCESS_BUSY = """
+import sys, time
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+for header in stdin:
+    data = stdin.read(int(header))
+    start = time.process_time()
+    while time.process_time() - start < 0.6:
+        pass
+    stdout.write(b"%d\\n" % len(data) + data)
+    stdout.flush()
+"""
+
 def analyse_result(ws, level, grp):
     assert os.path.isdir(os.path.join(ws.directory, grp))
     out_files = list(ws.find_files(fileGrp=grp, mimetype=MIMETYPE_PAGE))
@@ -64,3 +96,217 @@ def test_lines(workspace_aufklaerung):
     ws = workspace_aufklaerung['workspace']
     ws.save_mets()
     analyse_result(ws, 'TextLine', 'OCR-D-GT-PAGE-CPY')
+
+def test_lines_sequential(workspace_aufklaerung):
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'line', **PARAM,
+                             'max_procs': 1},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-GT-PAGE-CPY')
+
+def test_lines_pipe(workspace_aufklaerung):
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'line', **PARAM,
+                             'command': 'cp @STDIN @STDOUT'},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-GT-PAGE-CPY')
+
+def test_lines_cache(workspace_aufklaerung, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    for output_file_grp in ["OCR-D-GT-PAGE-CPY", "OCR-D-GT-PAGE-CPY2"]:
+        run_processor(ShellPreprocessor,
+                      input_file_grp="OCR-D-GT-PAGE",
+                      output_file_grp=output_file_grp,
+                      parameter={'level-of-operation': 'line', **PARAM,
+                                 'cache_dir': cache_dir},
+                      **workspace_aufklaerung,
+        )
+        assert len(os.listdir(cache_dir)) > 0, "found no cache entries"
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-GT-PAGE-CPY2')
+
+def test_lines_callable(workspace_aufklaerung):
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'line', **PARAM,
+                             'command': '',
+                             'callable': 'PIL.ImageOps:autocontrast'},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-GT-PAGE-CPY')
+
+def test_lines_callable_threads(workspace_aufklaerung):
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'line', **PARAM,
+                             'command': '',
+                             'callable': 'PIL.ImageOps:autocontrast',
+                             'callable_threads': True},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-GT-PAGE-CPY')
+
+def test_callable_sequential():
+    processor = ShellPreprocessor(None, parameter={**PARAM, 'command': '',
+                                                   'callable': 'PIL.ImageOps:autocontrast',
+                                                   'max_procs': 4})
+    assert processor.max_procs == 1, "callable is called concurrently without callable_threads"
+
+def test_callable_coprocess():
+    with pytest.raises(Exception, match="mutually exclusive"):
+        ShellPreprocessor(None, parameter={**PARAM, 'callable': 'PIL.ImageOps:autocontrast',
+                                           'coprocess': True})
+
+def test_cache_entry(tmp_path, caplog):
+    cache_dir = tmp_path / 'cache'
+    cache = ResultCache(str(cache_dir), 1024 * 1024, 'cp', getLogger('ocrd.test'))
+    image = Image.new('L', (20, 10), 128)
+    image.info['dpi'] = (300, 300)
+    key = cache.key(image)
+    assert cache.get(key) is None
+    cache.put(key, image)
+    cached = cache.get(key)
+    assert cached.tobytes() == image.tobytes()
+    assert cached.info['dpi'] == image.info['dpi'], "cache hit differs from miss in resolution"
+    # failing to store is not fatal
+    for entry in cache_dir.iterdir():
+        entry.unlink()
+    cache_dir.rmdir()
+    cache.put(key, image)
+    assert "Cannot add result to cache" in caplog.text
+
+def test_regions_timeout(workspace_aufklaerung):
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'region', **PARAM,
+                             'command': 'sleep 30 && cp @INFILE @OUTFILE',
+                             'timeout': 0.5},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    out_images = list(ws.find_files(fileGrp="OCR-D-GT-PAGE-CPY", mimetype="//^image/.*"))
+    assert not len(out_images), "found output image file despite timeout"
+
+def test_page_cputime(workspace_aufklaerung):
+    start = time.time()
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'page', **PARAM,
+                             'command': sys.executable + ' -c "while True: pass" @INFILE @OUTFILE',
+                             # only as a fallback
+                             'timeout': 30,
+                             'max_cputime': 0.5},
+                  **workspace_aufklaerung,
+    )
+    assert time.time() - start < 30, "command was not killed by CPU time limit"
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    out_images = list(ws.find_files(fileGrp="OCR-D-GT-PAGE-CPY", mimetype="//^image/.*"))
+    assert not len(out_images), "found output image file despite CPU time limit"
+
+def test_lines_coprocess(workspace_aufklaerung):
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'line', **PARAM,
+                             'command': sys.executable + ' -c ' + shlex.quote(COPROCESS),
+                             'coprocess': True},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-GT-PAGE-CPY')
+
+def test_regions_coprocess_cputime(workspace_aufklaerung):
+    # more CPU time in total than allowed for each answer
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'region', **PARAM,
+                             'command': sys.executable + ' -c ' + shlex.quote(COPROCESS_BUSY),
+                             'coprocess': True,
+                             'max_cputime': 1},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    regions = 0
+    for page_file in ws.find_files(fileGrp="OCR-D-GT-PAGE", mimetype=MIMETYPE_PAGE):
+        regions += len(page_from_file(page_file).etree.xpath('//page:TextRegion', namespaces=NAMESPACES))
+    assert regions > 2
+    out_images = list(ws.find_files(fileGrp="OCR-D-GT-PAGE-CPY", mimetype="//^image/.*"))
+    assert len(out_images) == regions, "coprocess was killed despite staying within the CPU time per answer"
+
+def test_lines_batch(workspace_aufklaerung):
+    run_processor(ShellPreprocessor,
+                  input_file_grp="OCR-D-GT-PAGE",
+                  output_file_grp="OCR-D-GT-PAGE-CPY",
+                  parameter={'level-of-operation': 'line', **PARAM,
+                             'output_mimetype': 'image/png',
+                             'command': 'cp @INDIR/* @OUTDIR'},
+                  **workspace_aufklaerung,
+    )
+    ws = workspace_aufklaerung['workspace']
+    ws.save_mets()
+    analyse_result(ws, 'TextLine', 'OCR-D-GT-PAGE-CPY')
+
+def test_split_command():
+    assert split_command("cp '@INFILE' @OUTFILE") == ["cp", "@INFILE", "@OUTFILE"]
+    # needs the shell
+    assert split_command("cp @INFILE @OUTFILE && true") is None
+    assert split_command("FOO=1 cp @INFILE @OUTFILE") is None
+    # unbalanced quote: left to the shell to report
+    assert split_command('cp "@INFILE @OUTFILE') is None
+
+@pytest.mark.skipif(PRLIMIT is None, reason="needs the prlimit tool")
+def test_limit_command():
+    # limits apply from the start, also to processes started by the command
+    for command in ["ulimit -t; sh -c 'ulimit -v'", ["sh", "-c", "ulimit -t; sh -c 'ulimit -v'"]]:
+        output = subprocess.check_output(limit_command(command, cputime=1.5, memory=100))
+        assert output.split() == [b"2", b"102400"]
+
+@pytest.mark.parametrize("mimetype", ["image/bmp", "image/gif", "image/jpeg", "image/png",
+                                      "image/x-portable-pixmap", "image/tiff"])
+def test_encoding_speed(mimetype):
+    image = Image.open(assets.path_to('kant_aufklaerung_1784/data/OCR-D-IMG/OCR-D-IMG_0001.tif'))
+    image.load()
+    megapixels = image.width * image.height / 1e6
+    results = {}
+    for fast in [False, True]:
+        start = time.perf_counter()
+        data = BytesIO()
+        encode_image(image, data, mimetype, fast=fast)
+        encoding = time.perf_counter() - start
+        size = data.tell()
+        start = time.perf_counter()
+        data.seek(0)
+        image2 = Image.open(data)
+        image2.load()
+        decoding = time.perf_counter() - start
+        assert image2.size == image.size
+        results[fast] = image2
+        print("%s (%s): %d bytes, encoding %.1fms/MP, decoding %.1fms/MP" % (
+            mimetype, "fast" if fast else "default", size,
+            1e3 * encoding / megapixels, 1e3 * decoding / megapixels))
+    if mimetype in ["image/png", "image/tiff"]:
+        assert results[True].tobytes() == results[False].tobytes(), "lossless encodings differ"
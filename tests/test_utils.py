@@ -0,0 +1,108 @@
+# pylint: disable=import-error
+
+import logging
+import time
+
+import numpy as np
+import pytest
+
+from ocrd import Resolver
+from ocrd_utils import MIMETYPE_PAGE, pushd_popd
+from ocrd_models.ocrd_page import AlternativeImageType
+from ocrd_modelfactory import page_from_file
+
+from ocrd_wrap.utils import iter_segments, map_segments
+
+from .assets import assets
+
+
+LEVELS = ['region', 'line', 'word', 'glyph']
+
+def nested_segments(workspace, page, page_image, page_coords, level):
+    # reference: images on all levels, from their immediate parents
+    segments = []
+    def walk(segment, image, coords, depth):
+        if depth == 0:
+            children = segment.get_AllRegions(classes=['Text'])
+        else:
+            children = getattr(segment, ['get_TextLine', 'get_Word', 'get_Glyph'][depth - 1])()
+        for child in children:
+            child_image, child_coords = workspace.image_from_segment(
+                child, image, coords, feature_filter='binarized')
+            if LEVELS[depth] == level:
+                segments.append((child, child_image, child_coords))
+            else:
+                walk(child, child_image, child_coords, depth + 1)
+    walk(page, page_image, page_coords, 0)
+    return segments
+
+@pytest.fixture
+def workspace_page(tmpdir):
+    ws = Resolver().workspace_from_url(assets.url_of('kant_aufklaerung_1784/data/mets.xml'),
+                                       dst_dir=str(tmpdir), download=True)
+    with pushd_popd(ws.directory):
+        page_file = next(ws.find_files(fileGrp='OCR-D-GT-PAGE', mimetype=MIMETYPE_PAGE))
+        page = page_from_file(ws.download_file(page_file)).get_Page()
+        yield ws, page, page_file.pageId
+
+@pytest.mark.parametrize("level", LEVELS)
+def test_iter_segments(workspace_page, level):
+    ws, page, page_id = workspace_page
+    regions = page.get_AllRegions(classes=['Text'])
+    # force each kind of intermediate image: orientation, protruding child, AlternativeImage
+    regions[0].set_orientation(1.5)
+    line = regions[1].get_TextLine()[0]
+    line.get_Coords().set_points(' '.join(
+        '%d,%s' % (int(x) - 40, y) for x, y in
+        (point.split(',') for point in line.get_Coords().points.split())))
+    word = regions[1].get_TextLine()[1].get_Word()[0]
+    word.add_AlternativeImage(AlternativeImageType(
+        filename=page.get_imageFilename(), comments='cropped'))
+    page_image, page_coords, _ = ws.image_from_page(page, page_id, feature_filter='binarized')
+    expected = nested_segments(ws, page, page_image, page_coords, level)
+    result = list(iter_segments(ws, logging.getLogger('test'),
+                                page, page_id, page_image, page_coords, level,
+                                feature_filter='binarized'))
+    assert [segment.id for segment, _, _ in result] == [segment.id for segment, _, _ in expected]
+    for (segment, image, coords), (_, expected_image, expected_coords) in zip(result, expected):
+        assert image.size == expected_image.size, segment.id
+        assert np.array_equal(np.array(image), np.array(expected_image)), segment.id
+        assert np.allclose(coords['transform'], expected_coords['transform']), segment.id
+        assert coords['angle'] == expected_coords['angle']
+        assert coords['features'] == expected_coords['features']
+
+def test_iter_segments_speed(workspace_page):
+    ws, page, page_id = workspace_page
+    page_image, page_coords, _ = ws.image_from_page(page, page_id, feature_filter='binarized')
+    # scale up to the size of a typical scan
+    page_image = page_image.resize((3 * page_image.width, 3 * page_image.height)).convert('RGB')
+    page.set_imageWidth(page_image.width)
+    page.set_imageHeight(page_image.height)
+    lines = page.get_AllTextLines()
+    words = [word for line in lines for word in line.get_Word()]
+    glyphs = [glyph for word in words for glyph in word.get_Glyph()]
+    for segment in page.get_AllRegions(classes=['Text']) + lines + words + glyphs:
+        segment.get_Coords().set_points(' '.join(
+            '%d,%d' % (3 * int(x), 3 * int(y)) for x, y in
+            (point.split(',') for point in segment.get_Coords().points.split())))
+    for level in LEVELS:
+        start = time.perf_counter()
+        expected = nested_segments(ws, page, page_image, page_coords, level)
+        nested = time.perf_counter() - start
+        start = time.perf_counter()
+        result = list(iter_segments(ws, logging.getLogger('test'),
+                                    page, page_id, page_image, page_coords, level,
+                                    feature_filter='binarized'))
+        lazy = time.perf_counter() - start
+        print("%d %ss: nested %.1fms, lazy %.1fms" % (len(result), level, 1e3 * nested, 1e3 * lazy))
+        assert len(result) == len(expected)
+        for (_, image, _), (_, expected_image, _) in zip(result, expected):
+            assert np.array_equal(np.array(image), np.array(expected_image))
+
+def test_map_segments():
+    def func(index, delay):
+        time.sleep(delay)
+        return index
+    segments = [(index, 0.01 * (index % 3)) for index in range(20)]
+    for workers in [1, 4]:
+        assert map_segments(func, iter(segments), workers) == list(range(20))